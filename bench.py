@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the rocketbot hot path.
+# Run with: python3 bench.py
+#
+# Replay benchmark, pushes recorded frames (from a bot started with
+# capture_path=...) or synthetic ones through the bot with no server:
+#   python3 bench.py replay [--frames capture.jsonl] [--save baseline.json]
+#                           [--baseline baseline.json]
+
+import argparse
+import base64
+import json
+import logging
+import time
+import tracemalloc
+import uuid
+
+# A chat frame shaped like the ones stream-room-messages sends us
+def synthetic_chat_frame(room_id="GENERAL", text="checkin", user="someone", i=0):
+    return json.dumps({
+        "msg": "changed",
+        "collection": "stream-room-messages",
+        "id": "id",
+        "fields": {
+            "eventName": room_id,
+            "args": [{
+                "_id": "msg{}".format(i),
+                "rid": room_id,
+                "msg": text,
+                "ts": {"$date": 1539000000000 + i},
+                "u": {"_id": "uid-{}".format(user), "username": user, "name": user},
+                "unread": True,
+                "_updatedAt": {"$date": 1539000000000 + i},
+            }]
+        }
+    })
+
+def _frames_per_second(frames, fn):
+    started = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    return frames / (time.perf_counter() - started)
+
+# Inbound and outbound frame logging with DEBUG off, the way the bot used to
+# do it (serialize for the log call no matter what) and the way it does now
+def bench_frame_logging(frames=50000):
+    logger = logging.getLogger("rocketbot.bench")
+    logger.setLevel(logging.INFO)
+    frame = synthetic_chat_frame()
+    request = {
+        "msg": "method",
+        "method": "sendMessage",
+        "id": str(uuid.uuid4()),
+        "params": [{"_id": str(uuid.uuid4()), "rid": "GENERAL", "msg": "Hi, @someone", "attachments": None}]
+    }
+
+    def eager_recv():
+        message = json.loads(frame)
+        logger.debug("Web socket message: {}".format(json.dumps(message)))
+
+    def lazy_recv():
+        message = json.loads(frame)
+        logger.debug("Web socket message: %s", frame)
+
+    def eager_send():
+        logger.debug("Sending message: {}".format(json.dumps(request)))
+        return json.dumps(request)
+
+    def lazy_send():
+        msg_frame = json.dumps(request)
+        logger.debug("Sending message: %s", msg_frame)
+        return msg_frame
+
+    results = {}
+    for name, eager, lazy in (("recv", eager_recv, lazy_recv), ("send", eager_send, lazy_send)):
+        before = _frames_per_second(frames, eager)
+        after = _frames_per_second(frames, lazy)
+        results[name] = (before, after)
+        print("{:<6} eager {:>10.0f} frames/s   lazy {:>10.0f} frames/s   x{:.2f}".format(
+            name, before, after, after / before))
+    return results
+
+# Parse + serialize round trip for every codec that is installed
+def bench_codecs(frames=50000):
+    import rocketbot
+    frame = synthetic_chat_frame()
+    results = {}
+    for name in ("json", "ujson", "orjson"):
+        try:
+            codec = rocketbot.get_codec(name)
+        except ImportError:
+            print("{:<6} not installed".format(name))
+            continue
+        results[name] = _frames_per_second(frames, lambda: codec.dumps(codec.loads(frame)))
+        print("{:<6} {:>10.0f} frames/s".format(name, results[name]))
+    return results
+
+# Frames from a capture_path file, binary ones come back as bytes
+def load_frames(path):
+    frames = []
+    with open(path, encoding="utf-8") as capture:
+        for line in capture:
+            if line.strip():
+                record = json.loads(line)
+                if "frame_b64" in record:
+                    frames.append(base64.b64decode(record["frame_b64"]))
+                else:
+                    frames.append(record["frame"])
+    return frames
+
+# A mix like a busy desk channel: chat across rooms, some of it check-ins,
+# the bot's own replies echoed back (filtered out) and the odd ping
+def synthetic_frames(count=20000, rooms=20, users=200):
+    frames = []
+    for i in range(count):
+        room_id = "ROOM{}".format(i % rooms)
+        if i % 50 == 0:
+            frames.append(json.dumps({"msg": "ping"}))
+        elif i % 10 == 0:
+            frames.append(synthetic_chat_frame(room_id, "Hi, @user", "replaybot", i))
+        else:
+            text = "checkin" if i % 3 == 0 else "is anyone at the desk?"
+            frames.append(synthetic_chat_frame(room_id, text, "user{}".format(i % users), i))
+    return frames
+
+# Stands in for the websocket, keeps what the bot sends
+class _ReplaySocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame):
+        self.sent.append(frame)
+
+    def close(self):
+        pass
+
+# A logged in bot with a check-in command, every room the frames mention
+# joined, the socket stubbed and REST answering with empty lists
+def replay_bot(frames):
+    import rocketbot
+
+    class ReplayBot(rocketbot.WebsocketRocketBot):
+        def handle_chat_message(self, message):
+            self.commands.dispatch(message)
+
+        def handle_checkin(self, message):
+            self.respond("Hi, @{}".format(message["user_name"]))
+
+        def _rest_api_get(self, api_method):
+            return {"channels": [], "groups": [], "ims": [], "total": 0}
+
+    bot = ReplayBot("replay.invalid", "replaybot", "password", raise_exceptions=True,
+                    reconnect=False, send_ack_timeout=None)
+    bot.logger.setLevel(logging.WARNING)
+    bot.commands.add("checkin", bot.handle_checkin)
+    bot.ws = _ReplaySocket()
+    bot.logged_in = True
+    bot.user_id = "replaybot"
+    bot._connect_started = time.perf_counter()
+    for frame in frames:
+        if isinstance(frame, bytes):
+            frame = frame.decode("utf-8", "replace")
+        if "stream-room-messages" not in frame:
+            continue
+        message = json.loads(frame)
+        for args in message.get("fields", {}).get("args", []):
+            if isinstance(args, dict) and "rid" in args and args["rid"] not in bot.room_list_by_id:
+                bot._add_joined_channel({"_id": args["rid"], "name": args["rid"]})
+    return bot
+
+# Answers the method calls the bot sent, the way the server would
+def _ack_sent(bot):
+    for frame in bot.ws.sent:
+        request = json.loads(frame)
+        if request.get("msg") == "method":
+            bot._pending_calls.resolve({"msg": "result", "id": request["id"], "result": {}})
+    bot.ws.sent.clear()
+
+# Feeds every frame through _handle_frame (decode + _handle_message), timing
+# each one. Acks are answered between frames, outside the timing.
+def _replay_timed(bot, frames):
+    latencies = []
+    perf_counter = time.perf_counter
+    for frame in frames:
+        started = perf_counter()
+        bot._handle_frame(frame, started)
+        latencies.append(perf_counter() - started)
+        if bot.ws.sent:
+            _ack_sent(bot)
+    return latencies
+
+# Same again under tracemalloc: bytes allocated while handling a frame
+# (peak over what was live before it) and bytes still held afterwards
+def _replay_allocations(bot, frames):
+    tracemalloc.start()
+    try:
+        start_current = tracemalloc.get_traced_memory()[0]
+        allocated = 0
+        for frame in frames:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            bot._handle_frame(frame, time.perf_counter())
+            allocated += tracemalloc.get_traced_memory()[1] - before
+            if bot.ws.sent:
+                _ack_sent(bot)
+        retained = tracemalloc.get_traced_memory()[0] - start_current
+    finally:
+        tracemalloc.stop()
+    return allocated / len(frames), retained / len(frames)
+
+def bench_replay(frames, warmup=1000):
+    import rocketbot
+    bot = replay_bot(frames)
+    _replay_timed(bot, frames[:warmup])
+    latencies = sorted(_replay_timed(bot, frames))
+    allocated, retained = _replay_allocations(replay_bot(frames), frames)
+    results = {
+        "frames": len(frames),
+        "frames_per_sec": len(latencies) / sum(latencies),
+        "p50_us": rocketbot._percentile(latencies, 0.5) * 1e6,
+        "p99_us": rocketbot._percentile(latencies, 0.99) * 1e6,
+        "alloc_bytes_per_frame": allocated,
+        "retained_bytes_per_frame": retained,
+    }
+    for name, value in results.items():
+        print("{:<26} {:>12.1f}".format(name, value))
+    return results
+
+# Prints each result next to the baseline's, lower is better except frames/s
+def compare_to_baseline(results, baseline):
+    print("{:<26} {:>12} {:>12} {:>8}".format("", "baseline", "now", "change"))
+    for name, value in results.items():
+        before = baseline.get(name)
+        if name == "frames" or not before:
+            continue
+        change = (value - before) / before * 100
+        better = change > 0 if name == "frames_per_sec" else change < 0
+        print("{:<26} {:>12.1f} {:>12.1f} {:>+7.1f}% {}".format(
+            name, before, value, change, "better" if better else "worse"))
+
+def main():
+    parser = argparse.ArgumentParser(description="rocketbot benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    replay = commands.add_parser("replay", help="replay recorded or synthetic frames through the bot")
+    replay.add_argument("--frames", help="JSONL file written with capture_path, synthetic frames if left out")
+    replay.add_argument("--synthetic", type=int, default=20000, help="number of synthetic frames")
+    replay.add_argument("--save", help="write the results to this file, to compare against later")
+    replay.add_argument("--baseline", help="compare the results against a file written with --save")
+    args = parser.parse_args()
+
+    if args.command != "replay":
+        bench_frame_logging()
+        bench_codecs()
+        return
+
+    frames = load_frames(args.frames) if args.frames else synthetic_frames(args.synthetic)
+    results = bench_replay(frames)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare_to_baseline(results, json.load(baseline_file))
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump(results, save_file, indent=2)
+
+if __name__ == "__main__":
+    main()
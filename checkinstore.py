@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+import weakref
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import psycopg2.pool
+
+# Buffers check-in rows and writes them to Postgres in batches.
+# A batch goes out when batch_size rows are waiting or flush_interval
+# seconds after its first row, whichever comes first. Each batch is one
+# multi-row INSERT in one transaction. If a batch fails it is written
+# again row by row through a prepared INSERT, so one bad row only loses
+# itself. Connections come from a pool shared by the flush thread and
+# explicit flush() calls.
+class CheckinWriter:
+    def __init__(self, dsn, table="checkin", columns=("name",),
+                 batch_size=50, flush_interval=1.0, minconn=1, maxconn=4):
+        self.table = table
+        self.columns = tuple(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        # Connections that have checkin_insert prepared. Weak, so a connection
+        # the pool closes drops out rather than leaving an id a new one
+        # could reuse.
+        self._prepared = weakref.WeakSet()
+        self._insert_sql = "INSERT INTO {} ({}) VALUES %s".format(table, ", ".join(self.columns))
+        self._prepare_sql = "PREPARE checkin_insert AS INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(self.columns),
+            ", ".join("${}".format(i + 1) for i in range(len(self.columns))))
+        self._execute_sql = "EXECUTE checkin_insert ({})".format(", ".join(["%s"] * len(self.columns)))
+
+        self._cond = threading.Condition()
+        self._rows = []
+        self._first_row_at = None
+        self._closed = False
+
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches = 0
+        self.transactions = 0
+
+        self._thread = threading.Thread(target=self._run, name="checkin-writer", daemon=True)
+        self._thread.start()
+
+    # Queue one row, values in the order of columns
+    def add(self, *values):
+        if len(values) != len(self.columns):
+            raise AssertionError("Expected {} values, got {}".format(len(self.columns), len(values)))
+        with self._cond:
+            if self._closed:
+                raise AssertionError("CheckinWriter is closed")
+            if not self._rows:
+                self._first_row_at = time.monotonic()
+            self._rows.append(values)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self):
+        return len(self._rows)
+
+    # Write everything that is waiting right now
+    def flush(self):
+        with self._cond:
+            rows = self._take_rows()
+        if rows:
+            self._write(rows)
+
+    # Flush what's left and close the pool
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        self._pool.closeall()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._rows),
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "batches": self.batches,
+                "transactions": self.transactions,
+            }
+
+    # The flush thread and flush() both write, so counters move under the lock
+    def _count(self, rows_written=0, rows_failed=0, batches=0, transactions=0):
+        with self._cond:
+            self.rows_written += rows_written
+            self.rows_failed += rows_failed
+            self.batches += batches
+            self.transactions += transactions
+
+    def _take_rows(self):
+        rows = self._rows
+        self._rows = []
+        self._first_row_at = None
+        return rows
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.batch_size:
+                        break
+                    if self._rows:
+                        wait = self._first_row_at + self.flush_interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+                rows = self._take_rows()
+            try:
+                self._write(rows)
+            except Exception as e:
+                self._count(rows_failed=len(rows))
+                self.logger.error("Dropping {} check-ins: {}".format(len(rows), e))
+
+    def _write(self, rows):
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, self._insert_sql, rows, page_size=len(rows))
+            conn.commit()
+            self._count(rows_written=len(rows), batches=1, transactions=1)
+            return
+        except psycopg2.Error as e:
+            if not conn.closed:
+                conn.rollback()
+            self._count(transactions=1)
+            self.logger.warning("Batch of {} check-ins failed, writing them one by one: {}".format(len(rows), e))
+        finally:
+            self._put_connection(conn)
+        # If the server dropped the connection mid batch it went back to
+        # the pool closed, so this is a fresh one
+        conn = self._pool.getconn()
+        try:
+            self._write_rows(conn, rows)
+        finally:
+            self._put_connection(conn)
+
+    # A connection the server dropped goes back closed, the pool opens a
+    # fresh one next time
+    def _put_connection(self, conn):
+        self._pool.putconn(conn, close=bool(conn.closed))
+
+    # Fallback path, one transaction per row
+    def _write_rows(self, conn, rows):
+        try:
+            self._prepare(conn)
+        except psycopg2.Error as e:
+            if not conn.closed:
+                conn.rollback()
+            self._count(rows_failed=len(rows))
+            self.logger.error("Dropping {} check-ins, can't prepare insert: {}".format(len(rows), e))
+            return
+        for row in rows:
+            try:
+                self._execute(conn, row)
+                self._count(rows_written=1, transactions=1)
+            except psycopg2.Error as e:
+                if not conn.closed:
+                    conn.rollback()
+                self._count(rows_failed=1, transactions=1)
+                self.logger.error("Dropping check-in {}: {}".format(row, e))
+
+    # If the server lost the prepared statement (DISCARD ALL, a pooler
+    # handing out another backend) prepare it again and retry the row once
+    def _execute(self, conn, row):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(self._execute_sql, row)
+            conn.commit()
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.rollback()
+            self._count(transactions=1)
+            self._prepared.discard(conn)
+            self._prepare(conn)
+            with conn.cursor() as cur:
+                cur.execute(self._execute_sql, row)
+            conn.commit()
+
+    # Prepared statements live per connection
+    def _prepare(self, conn):
+        if conn in self._prepared:
+            return
+        with conn.cursor() as cur:
+            cur.execute(self._prepare_sql)
+        conn.commit()
+        self._count(transactions=1)
+        self._prepared.add(conn)
@@ -0,0 +1,90 @@
+import logging
+import socket
+import threading
+import time
+import uuid
+
+import geolocate
+import netinfo
+
+# Facts about the desk machine the bot runs on: MAC address, hostname,
+# public IP and the address of the desk interface.
+# They are computed once up front and refreshed by a background thread
+# every ttl seconds, so handlers read them without doing any work.
+# A fact that fails to refresh keeps its last known value.
+# The public IP and location come from resolver, a
+# geolocate.PublicIPResolver (online geojs lookups by default).
+class DeskFacts:
+    def __init__(self, interface="ens3", ttl=300, refresh_in_background=True, resolver=None):
+        self.interface = interface
+        self.ttl = ttl
+        self.resolver = resolver if resolver is not None else geolocate.PublicIPResolver()
+        self.logger = logging.getLogger(__name__)
+        self.refreshed_at = None
+        self._facts = {}
+        self.refresh()
+        if refresh_in_background:
+            self._thread = threading.Thread(target=self._run, name="desk-facts", daemon=True)
+            self._thread.start()
+
+    @property
+    def macaddr(self):
+        return self._facts.get("macaddr")
+
+    @property
+    def hostname(self):
+        return self._facts.get("hostname")
+
+    # None until the resolver's first answer
+    @property
+    def public_ip(self):
+        return self.resolver.ip
+
+    @property
+    def location(self):
+        return self.resolver.current()
+
+    @property
+    def desk_ip(self):
+        return self._facts.get("desk_ip")
+
+    def snapshot(self):
+        facts = dict(self._facts)
+        facts["public_ip"] = self.public_ip
+        return facts
+
+    # Name -> function computing the fact. Override to add or replace facts.
+    def sources(self):
+        return {
+            "macaddr": self._lookup_macaddr,
+            "hostname": socket.gethostname,
+            "desk_ip": self._lookup_desk_ip,
+        }
+
+    # Recompute every fact and swap them in at once
+    def refresh(self):
+        facts = dict(self._facts)
+        for name, compute in self.sources().items():
+            try:
+                facts[name] = compute()
+            except Exception as e:
+                self.logger.warning("Can't refresh {}: {}".format(name, e))
+        self._facts = facts
+        self.refreshed_at = time.monotonic()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl)
+            self.refresh()
+
+    # Same format as hex(uuid.getnode()), which it falls back on when the
+    # desk interface has no MAC
+    def _lookup_macaddr(self):
+        mac = netinfo.mac_address(self.interface)
+        if mac is None:
+            return hex(uuid.getnode())
+        return hex(int(mac.replace(":", ""), 16))
+
+    # IPv4 addresses of the desk interface, one per line
+    def _lookup_desk_ip(self):
+        return "\n".join(netinfo.ipv4_addresses(self.interface))
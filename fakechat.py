@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import random
+import struct
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+# A stand-in Rocket.Chat server for testing bots offline.
+# It speaks the parts of DDP the bots use (connect, ping/pong, login with
+# password or resume token, sub stream-room-messages and stream-notify-user,
+# methods sendMessage and joinRoom) on ws://host:port/websocket, and answers
+# the REST lists the bots walk (channels.list.joined, groups.list, im.list,
+# channels.list, all paginated with count/offset) on http://host:port.
+# Point a bot at it with use_tls=False:
+#   server = FakeRocketChat(rooms=50, message_rate=20).start()
+#   bot = WebsocketRocketBot(server.domain, "bot", "password", use_tls=False)
+# or run it on its own: python3 fakechat.py --port 3000 --rooms 50 --rate 20
+#
+# Every user that logs in is a member of every channel and group, and gets
+# dms direct messages with fake users. message_rate messages per second
+# are posted by chatters fake users into random rooms. Outgoing DDP frames
+# can be delayed by latency (+ up to latency_jitter) seconds and, except
+# for the connect and login handshake, dropped with probability drop_rate.
+# REST answers get the same delay. disconnect_interval closes every client
+# connection that often, to exercise reconnects.
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_OP_CONTINUATION = 0x0
+_OP_TEXT = 0x1
+_OP_CLOSE = 0x8
+_OP_PING = 0x9
+_OP_PONG = 0xA
+
+class FakeRocketChat:
+    # users maps username -> password, None lets anyone log in with any password
+    def __init__(self, host="127.0.0.1", port=0, users=None, rooms=10, groups=0, dms=0,
+                 public_rooms=0, message_rate=0, chatters=50, texts=("checkin", "hello", "anyone at the desk?"),
+                 latency=0, latency_jitter=0, drop_rate=0, ping_interval=None, disconnect_interval=None,
+                 page_limit=100, seed=None):
+        self.host = host
+        self.port = port
+        self.users = users
+        self.dms = dms
+        self.message_rate = message_rate
+        self.chatters = chatters
+        self.texts = texts
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.drop_rate = drop_rate
+        self.ping_interval = ping_interval
+        self.disconnect_interval = disconnect_interval
+        self.page_limit = page_limit
+        self.logger = logging.getLogger(__name__)
+        self._random = random.Random(seed)
+
+        # Room id -> room, and the channels and groups everyone is in
+        self.rooms = {}
+        self._joined = []
+        self._joined_ids = set()
+        for i in range(rooms):
+            self._add_room("CH{:05d}".format(i), "channel-{}".format(i), "c", joined=True)
+        for i in range(groups):
+            self._add_room("GR{:05d}".format(i), "group-{}".format(i), "p", joined=True)
+        for i in range(public_rooms):
+            self._add_room("PU{:05d}".format(i), "public-{}".format(i), "c", joined=False)
+        # username -> [DM rooms], made on first login
+        self._ims = {}
+        # token -> username
+        self._tokens = {}
+        self._message_ids = set()
+        self._clients = set()
+        self._listeners = []
+
+        self.stats = {
+            "connections": 0,
+            "logins": 0,
+            "resumes": 0,
+            "frames_in": 0,
+            "frames_out": 0,
+            "frames_dropped": 0,
+            "rest_calls": 0,
+            "messages_posted": 0,
+            "messages_received": 0,
+            "duplicate_sends": 0,
+        }
+
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._stopped = None
+
+    # host:port, the domain to give the bot
+    @property
+    def domain(self):
+        return "{}:{}".format(self.host, self.port)
+
+    # Rooms every user is in (channels and groups)
+    def joined_rooms(self):
+        return list(self._joined)
+
+    # Whether username has a connection that gets room_id's messages
+    def is_subscribed(self, username, room_id):
+        for client in list(self._clients):
+            if client.username != username:
+                continue
+            if room_id in client.subscriptions:
+                return True
+            if "__my_messages__" in client.subscriptions and self._is_member(username, room_id):
+                return True
+        return False
+
+    # Runs the server on a daemon thread, returns once it is listening
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fakechat", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join()
+
+    # Called on the server thread with every message a client sends
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    # Post a message as username, from any thread. Returns the message.
+    def post_message(self, room_id, text, username):
+        message = self._message(room_id, text, username)
+        self._loop.call_soon_threadsafe(self._post, message)
+        return message
+
+    # Drop every client connection, from any thread
+    def disconnect_all(self):
+        self._loop.call_soon_threadsafe(self._disconnect_all)
+
+    def _run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        background = []
+        if self.message_rate:
+            background.append(self._loop.create_task(self._chatter()))
+        if self.disconnect_interval:
+            background.append(self._loop.create_task(self._disconnect_periodically()))
+        self._ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            for task in background:
+                task.cancel()
+            self._server.close()
+            self._disconnect_all()
+            await self._server.wait_closed()
+
+    def _add_room(self, room_id, name, room_type, joined):
+        self.rooms[room_id] = {
+            "_id": room_id,
+            "name": name,
+            "fname": name,
+            "t": room_type,
+            "_updatedAt": {"$date": int(time.time() * 1000)},
+        }
+        if joined:
+            self._joined.append(self.rooms[room_id])
+            self._joined_ids.add(room_id)
+
+    def _ims_for(self, username):
+        ims = self._ims.get(username)
+        if ims is None:
+            ims = self._ims[username] = []
+            for i in range(self.dms):
+                other = "user{}".format(i)
+                room_id = "DM{}{}".format(username, other)
+                im = {"_id": room_id, "t": "d", "usernames": [username, other],
+                      "_updatedAt": {"$date": int(time.time() * 1000)}}
+                ims.append(im)
+                self.rooms[room_id] = im
+        return ims
+
+    def _message(self, room_id, text, username):
+        now = int(time.time() * 1000)
+        return {
+            "_id": uuid.uuid4().hex[:17],
+            "rid": room_id,
+            "msg": text,
+            "ts": {"$date": now},
+            "u": {"_id": "uid-{}".format(username), "username": username, "name": username},
+            "unread": True,
+            "_updatedAt": {"$date": now},
+        }
+
+    # Fans a message out to every client subscribed to its room
+    def _post(self, message):
+        self.stats["messages_posted"] += 1
+        room_id = message["rid"]
+        for client in list(self._clients):
+            if room_id in client.subscriptions:
+                event_name = room_id
+            elif "__my_messages__" in client.subscriptions and self._is_member(client.username, room_id):
+                event_name = "__my_messages__"
+            else:
+                continue
+            client.send({
+                "msg": "changed",
+                "collection": "stream-room-messages",
+                "id": "id",
+                "fields": {"eventName": event_name, "args": [message]},
+            })
+
+    def _is_member(self, username, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            return False
+        if room["t"] == "d":
+            return username in room["usernames"]
+        return room_id in self._joined_ids
+
+    async def _chatter(self):
+        rooms = [room["_id"] for room in self._joined]
+        if not rooms:
+            return
+        while True:
+            await asyncio.sleep(self._random.expovariate(self.message_rate))
+            username = "user{}".format(self._random.randrange(self.chatters))
+            self._post(self._message(self._random.choice(rooms), self._random.choice(self.texts), username))
+
+    async def _disconnect_periodically(self):
+        while True:
+            await asyncio.sleep(self.disconnect_interval)
+            self.logger.info("Dropping {} connections".format(len(self._clients)))
+            self._disconnect_all()
+
+    def _disconnect_all(self):
+        for client in list(self._clients):
+            client.close()
+
+    def _delay(self):
+        delay = self.latency
+        if self.latency_jitter:
+            delay += self._random.uniform(0, self.latency_jitter)
+        return delay
+
+    def _drop(self):
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.stats["frames_dropped"] += 1
+            return True
+        return False
+
+    # One TCP connection, either a websocket upgrade or keep-alive REST calls
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, version = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body_length = int(headers.get("content-length", 0))
+                if body_length:
+                    await reader.readexactly(body_length)
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self._handle_websocket(reader, writer, target, headers)
+                    return
+                await self._handle_rest(writer, method, target, headers)
+                if headers.get("connection", "").lower() == "close":
+                    return
+        # The server is shutting down
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            self.logger.error("Error on connection: {}".format(e))
+        finally:
+            writer.close()
+
+    async def _handle_rest(self, writer, method, target, headers):
+        self.stats["rest_calls"] += 1
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        await asyncio.sleep(self._delay())
+        username = self._tokens.get(headers.get("x-auth-token"))
+        if method != "GET":
+            status, body = 405, {"success": False, "error": "Method not allowed"}
+        elif username is None or headers.get("x-user-id") != "uid-{}".format(username):
+            status, body = 401, {"status": "error", "message": "You must be logged in to do this."}
+        else:
+            lists = {
+                "/api/v1/channels.list.joined": ("channels", [room for room in self._joined if room["t"] == "c"]),
+                "/api/v1/groups.list": ("groups", [room for room in self._joined if room["t"] == "p"]),
+                "/api/v1/im.list": ("ims", self._ims_for(username)),
+                "/api/v1/channels.list": ("channels", [room for room in self.rooms.values() if room["t"] == "c"]),
+            }
+            if url.path in lists:
+                key, rooms = lists[url.path]
+                status, body = 200, self._page(key, rooms, query)
+            else:
+                status, body = 404, {"success": False, "error": "Not found"}
+        data = json.dumps(body).encode("utf-8")
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+            status, "OK" if status == 200 else "Error", len(data)).encode("latin-1") + data)
+        await writer.drain()
+
+    def _page(self, key, rooms, query):
+        count = min(int(query.get("count", ["50"])[0]), self.page_limit)
+        offset = int(query.get("offset", ["0"])[0])
+        page = rooms[offset:offset + count]
+        return {key: page, "count": len(page), "offset": offset, "total": len(rooms), "success": True}
+
+    async def _handle_websocket(self, reader, writer, target, headers):
+        if urlsplit(target).path != "/websocket":
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            return
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + _WS_GUID).encode("ascii")).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        await writer.drain()
+
+        client = _Client(self, writer)
+        self._clients.add(client)
+        self.stats["connections"] += 1
+        client.send({"server_id": "0"}, droppable=False)
+        pinger = None
+        if self.ping_interval:
+            pinger = self._loop.create_task(self._ping(client))
+        try:
+            fragments = []
+            while True:
+                try:
+                    fin, opcode, payload = await _read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if opcode == _OP_CLOSE:
+                    return
+                if opcode == _OP_PING:
+                    client.send_raw(_encode_frame(payload, _OP_PONG))
+                    continue
+                if opcode not in (_OP_TEXT, _OP_CONTINUATION):
+                    continue
+                fragments.append(payload)
+                if not fin:
+                    continue
+                frame = b"".join(fragments)
+                fragments = []
+                self.stats["frames_in"] += 1
+                self._handle_ddp(client, json.loads(frame))
+        finally:
+            if pinger is not None:
+                pinger.cancel()
+            self._clients.discard(client)
+            client.close()
+
+    async def _ping(self, client):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            client.send({"msg": "ping"}, droppable=False)
+
+    def _handle_ddp(self, client, message):
+        kind = message.get("msg")
+        if kind == "connect":
+            client.send({"msg": "connected", "session": uuid.uuid4().hex[:17]}, droppable=False)
+        elif kind == "ping":
+            client.send({"msg": "pong"}, droppable=False)
+        elif kind == "pong":
+            pass
+        elif kind == "sub":
+            param = message["params"][0]
+            client.subs[message["id"]] = param
+            client.subscriptions.add(param)
+            client.send({"msg": "ready", "subs": [message["id"]]})
+        elif kind == "unsub":
+            # Like Meteor, nosub comes back for unknown ids too
+            param = client.subs.pop(message["id"], None)
+            if param is not None and param not in client.subs.values():
+                client.subscriptions.discard(param)
+            client.send({"msg": "nosub", "id": message["id"]})
+        elif kind == "method":
+            self._handle_method(client, message)
+
+    def _handle_method(self, client, message):
+        method = message.get("method")
+        params = message.get("params") or []
+        if method == "login":
+            self._login(client, message["id"], params[0])
+            return
+        if client.username is None:
+            client.send(_error(message["id"], 401, "You must be logged in"))
+        elif method == "sendMessage":
+            self._send_message(client, message["id"], params[0])
+        elif method == "joinRoom":
+            if params and params[0] in self.rooms:
+                client.send({"msg": "result", "id": message["id"], "result": True})
+            else:
+                client.send(_error(message["id"], "error-invalid-room", "Invalid room"))
+        else:
+            client.send(_error(message["id"], 404, "Method '{}' not found".format(method)))
+
+    def _login(self, client, call_id, credentials):
+        if "resume" in credentials:
+            username = self._tokens.get(credentials["resume"])
+            login_type = "resume"
+        else:
+            username = credentials.get("user", {}).get("username")
+            password = self.users.get(username) if self.users is not None else None
+            if self.users is not None and (password is None or credentials.get("password", {}).get("digest") !=
+                                           hashlib.sha256(password.encode("utf-8")).hexdigest()):
+                username = None
+            login_type = "password"
+        if username is None:
+            client.send(_error(call_id, 403, "User not found"), droppable=False)
+            return
+        token = credentials["resume"] if login_type == "resume" else uuid.uuid4().hex
+        self._tokens[token] = username
+        client.username = username
+        self._ims_for(username)
+        self.stats["resumes" if login_type == "resume" else "logins"] += 1
+        client.send({
+            "msg": "result",
+            "id": call_id,
+            "result": {
+                "id": "uid-{}".format(username),
+                "token": token,
+                "tokenExpires": {"$date": int(time.time() * 1000) + 90 * 86400000},
+                "type": login_type,
+            },
+        }, droppable=False)
+
+    def _send_message(self, client, call_id, params):
+        room_id = params.get("rid")
+        if not self._is_member(client.username, room_id):
+            client.send(_error(call_id, "error-not-allowed", "Not allowed"))
+            return
+        message_id = params.get("_id") or uuid.uuid4().hex[:17]
+        # Like Mongo, a second insert with the same _id fails
+        if message_id in self._message_ids:
+            self.stats["duplicate_sends"] += 1
+            client.send(_error(call_id, 409, "E11000 duplicate key error collection: rocketchat_message"))
+            return
+        self._message_ids.add(message_id)
+        self.stats["messages_received"] += 1
+        message = self._message(room_id, params.get("msg", ""), client.username)
+        message["_id"] = message_id
+        if params.get("attachments"):
+            message["attachments"] = params["attachments"]
+        for listener in self._listeners:
+            listener(message)
+        client.send({"msg": "result", "id": call_id, "result": message})
+        self._post(message)
+
+# One websocket client. Outgoing frames go through a queue drained by a
+# writer task, which is where latency is added, so frames keep their order.
+class _Client:
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+        self.username = None
+        # Subscription id -> its first param (room id or user event key),
+        # and the params of every live subscription
+        self.subs = {}
+        self.subscriptions = set()
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.get_running_loop().create_task(self._write())
+
+    def send(self, message, droppable=True):
+        if droppable and self.server._drop():
+            return
+        self.send_raw(_encode_frame(json.dumps(message).encode("utf-8")))
+
+    def send_raw(self, data):
+        self._queue.put_nowait((time.monotonic() + self.server._delay(), data))
+
+    def close(self):
+        self._writer_task.cancel()
+        self.writer.close()
+
+    async def _write(self):
+        while True:
+            due, data = await self._queue.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.writer.write(data)
+            self.server.stats["frames_out"] += 1
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return
+
+def _error(call_id, error, reason):
+    return {
+        "msg": "result",
+        "id": call_id,
+        "error": {"isClientSafe": True, "error": error, "reason": reason,
+                  "message": "{} [{}]".format(reason, error), "errorType": "Meteor.Error"},
+    }
+
+async def _read_frame(reader):
+    head = await reader.readexactly(2)
+    fin = bool(head[0] & 0x80)
+    opcode = head[0] & 0x0F
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if head[1] & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None and length:
+        key = (mask * (length // 4 + 1))[:length]
+        payload = (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+    return fin, opcode, payload
+
+# Server frames are never masked
+def _encode_frame(payload, opcode=_OP_TEXT):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Rocket.Chat server for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--rooms", type=int, default=10, help="channels every user is in")
+    parser.add_argument("--groups", type=int, default=0, help="private groups every user is in")
+    parser.add_argument("--dms", type=int, default=0, help="direct messages per user")
+    parser.add_argument("--public-rooms", type=int, default=0, help="extra channels nobody is in")
+    parser.add_argument("--rate", type=float, default=0, help="chat messages per second from fake users")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every frame and REST call")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many more seconds, random")
+    parser.add_argument("--drop", type=float, default=0, help="fraction of frames to drop")
+    parser.add_argument("--ping-interval", type=float, default=None)
+    parser.add_argument("--disconnect-interval", type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s %(levelname)s] %(message)s")
+    server = FakeRocketChat(host=args.host, port=args.port, rooms=args.rooms, groups=args.groups,
+                            dms=args.dms, public_rooms=args.public_rooms, message_rate=args.rate,
+                            latency=args.latency, latency_jitter=args.jitter, drop_rate=args.drop,
+                            ping_interval=args.ping_interval,
+                            disconnect_interval=args.disconnect_interval).start()
+    server.logger.info("Listening on {}, bots need use_tls=False".format(server.domain))
+    try:
+        while True:
+            time.sleep(10)
+            server.logger.info(server.stats)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
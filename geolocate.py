@@ -0,0 +1,143 @@
+import ipaddress
+import logging
+import threading
+import time
+
+import requests
+
+import netinfo
+
+# Public IP and geolocation lookups.
+#
+# A backend answers resolve() with a dict holding at least "ip", plus
+# whatever location fields it knows ("country", "region", "city",
+# "latitude", "longitude"). PublicIPResolver keeps the last answer and
+# refreshes it from a background thread, so readers never wait on the
+# network.
+
+# Online backend, asks get.geojs.io
+class GeojsBackend:
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+
+    def resolve(self):
+        geo = requests.get('https://get.geojs.io/v1/ip/geo.json', timeout=self.timeout).json()
+        return {
+            "ip": geo["ip"],
+            "country": geo.get("country_code"),
+            "region": geo.get("region"),
+            "city": geo.get("city"),
+            "latitude": geo.get("latitude"),
+            "longitude": geo.get("longitude"),
+        }
+
+# Offline backend. The public IP is the first global address on the
+# machine's own interfaces (or a fixed one), the location comes from a
+# local database file: a MaxMind .mmdb through geoip2, or a legacy
+# GeoIP.dat through pygeoip.
+class GeoIPDatabaseBackend:
+    def __init__(self, path, ip=None, interface=None):
+        self.path = path
+        self.ip = ip
+        self.interface = interface
+        if path.endswith(".mmdb"):
+            import geoip2.database
+            self._reader = geoip2.database.Reader(path)
+            self._lookup = self._lookup_geoip2
+        else:
+            import pygeoip
+            self._reader = pygeoip.GeoIP(path)
+            self._lookup = self._lookup_pygeoip
+
+    def resolve(self):
+        ip = self.ip or self._local_public_ip()
+        if ip is None:
+            raise AssertionError("No global address on this machine")
+        location = {"ip": ip}
+        location.update(self._lookup(ip))
+        return location
+
+    def _local_public_ip(self):
+        if self.interface is not None:
+            candidates = netinfo.ipv4_addresses(self.interface)
+        else:
+            candidates = [address.address
+                          for interface in netinfo.interfaces().values()
+                          for address in interface.ipv4]
+        for candidate in candidates:
+            if ipaddress.ip_address(candidate).is_global:
+                return candidate
+        return None
+
+    def _lookup_geoip2(self, ip):
+        city = self._reader.city(ip)
+        return {
+            "country": city.country.iso_code,
+            "region": city.subdivisions.most_specific.name,
+            "city": city.city.name,
+            "latitude": city.location.latitude,
+            "longitude": city.location.longitude,
+        }
+
+    def _lookup_pygeoip(self, ip):
+        # Country-only databases have no records
+        try:
+            record = self._reader.record_by_addr(ip) or {}
+        except Exception:
+            return {"country": self._reader.country_code_by_addr(ip)}
+        return {
+            "country": record.get("country_code"),
+            "region": record.get("region_code"),
+            "city": record.get("city"),
+            "latitude": record.get("latitude"),
+            "longitude": record.get("longitude"),
+        }
+
+# Caches the backend's answer for ttl seconds. The first lookup and every
+# refresh run on a daemon thread, so current() only ever reads memory and
+# is None until the first answer arrives. After a failed refresh the last
+# answer is kept (and reported stale) and the lookup is retried sooner.
+class PublicIPResolver:
+    def __init__(self, backend=None, ttl=600, retry_interval=30, refresh_in_background=True):
+        self.backend = backend if backend is not None else GeojsBackend()
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.logger = logging.getLogger(__name__)
+        self.resolved_at = None
+        self._location = None
+        self._wake = threading.Event()
+        if refresh_in_background:
+            self._thread = threading.Thread(target=self._run, name="public-ip", daemon=True)
+            self._thread.start()
+
+    # Last known location dict, None if there's none yet
+    def current(self):
+        return self._location
+
+    @property
+    def ip(self):
+        location = self._location
+        return location["ip"] if location is not None else None
+
+    def is_stale(self):
+        return self.resolved_at is None or time.monotonic() - self.resolved_at > self.ttl
+
+    # Ask for a refresh now without waiting for it
+    def refresh_soon(self):
+        self._wake.set()
+
+    # Look the location up right away, on the calling thread
+    def refresh(self):
+        try:
+            self._location = self.backend.resolve()
+        except Exception as e:
+            self.logger.warning("Can't resolve public IP: {}".format(e))
+            return False
+        self.resolved_at = time.monotonic()
+        return True
+
+    def _run(self):
+        while True:
+            wait = self.ttl if self.refresh() else self.retry_interval
+            self._wake.wait(wait)
+            self._wake.clear()
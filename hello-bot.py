@@ -11,8 +11,8 @@ import yaml
 import re
 import yaml
 import json
-import psycopg2
 
+import checkinstore
 import rocketbot
 
 from datetime import datetime
@@ -23,13 +23,17 @@ DBNAME = 'wanitkun_cat'
 UNAME ='wanitkun_cat'
 PASS = 'epz5S5m*as'
 
-conn=psycopg2.connect("host={} dbname={} user={} password={}".format(DBHOST, DBNAME, UNAME, PASS))
-
-cur = conn.cursor()
+DSN = "host={} dbname={} user={} password={}".format(DBHOST, DBNAME, UNAME, PASS)
 
 # Example Bot Class
 # Says hello to people who start a message by mentioning it.
 class HelloBot(rocketbot.WebsocketRocketBot):
+	# checkins is a checkinstore.CheckinWriter, check-ins aren't stored without one
+	def __init__(self, *args, checkins=None, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.checkins = checkins
+		self.commands.add("checkin", self.handle_checkin)
+
  # Override the handle_message method to do our own thing.
 # 	def handle_chat_message(self, message):
 #		bot_mention = "@{}".format(self.user.lower())
@@ -42,14 +46,17 @@ class HelloBot(rocketbot.WebsocketRocketBot):
 #            	self.respond("Hi, @" + message["user_name"])
 
 	def handle_chat_message(self, message):
-		time = datetime.now()
 #		bot_mention = "checkin  @{}".format(self.user.lower())
 
 		self.logger.info("Incoming message: {}".format(message))
 		if message["user_name"].lower() != "jerrybot":
+			self.commands.dispatch(message)
 
-			if "checkin" in  message["text"].lower():
-				self.respond("Hi, @" + message["user_name"] + " On desk: " + " {}".format(time))
+	def handle_checkin(self, message):
+		time = datetime.now()
+		self.respond("Hi, @" + message["user_name"] + " On desk: " + " {}".format(time))
+		if self.checkins is not None:
+			self.checkins.add(message["user_name"])
 
 # Main Method
 if __name__ == "__main__":
@@ -62,7 +69,7 @@ if __name__ == "__main__":
         password = cfg["password"]
 
     # Create the bot
-    bot = HelloBot(domain, user, password)
+    bot = HelloBot(domain, user, password, checkins=checkinstore.CheckinWriter(DSN))
 
     # Make the bot run
     bot.start()
@@ -4,15 +4,11 @@ import yaml
 import re
 import yaml
 import json
-import psycopg2
 
+import checkinstore
+import deskfacts
 import rocketbot
 
-#IP CHECK ON DESK
-import socket
-import uuid
-import requests
-import subprocess
 from datetime import datetime
 
 MY_USERNAME = '#'
@@ -21,39 +17,41 @@ DBNAME = '#'
 UNAME ='#'
 PASS = '#'
 
-conn=psycopg2.connect("host={} dbname={} user={} password={}".format(DBHOST, DBNAME, UNAME, PASS))
-conn.autocommit = True
-cur = conn.cursor()
+DSN = "host={} dbname={} user={} password={}".format(DBHOST, DBNAME, UNAME, PASS)
 
 class Jaxbot(rocketbot.WebsocketRocketBot):
+    # checkins is a checkinstore.CheckinWriter, check-ins aren't stored without one
+    # facts is a deskfacts.DeskFacts, IP CHECK ON DESK reads from it
+    def __init__(self, *args, checkins=None, facts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkins = checkins
+        self.facts = facts if facts is not None else deskfacts.DeskFacts()
+        self.commands.add("checkin", self.handle_checkin)
  
     def handle_chat_message(self, message):
-        conn.rollback()
 #        name = input_json['user_name']
-        macaddr = hex(uuid.getnode())
-        hostname = socket.gethostname()
-        time = datetime.now()
-        ip_request = requests.get('https://get.geojs.io/v1/ip.json')
-        my_ip = ip_request.json()['ip']
+        self.logger.info("Incoming message: {}".format(message))
+        if message["user_name"].lower() != "jerrybot":
+            self.commands.dispatch(message)
 
-        process = subprocess.Popen(["ip addr show ens3 | grep 'inet ' | awk '{print $2}' | cut -f1 -d'/'"],shell = True, stdout=subprocess.PIPE)
-        stdout = process.communicate()[0]
+    def handle_checkin(self, message):
+        macaddr = self.facts.macaddr
+        hostname = self.facts.hostname
+        time = datetime.now()
+        my_ip = self.facts.public_ip
+        stdout = self.facts.desk_ip
 #        print('IP:{}'.format(stdout))
 
-        self.logger.info("Incoming message: {}".format(message))
-        if message["user_name"].lower() != "jerrybot":
-            if "checkin" in  message["text"].lower():
-#                if (macaddr.find("90b11c9d7834") != -1): # "0x90b11c9d7834" in macaddr or "0x180373202fcb" in macaddr:
-                    self.respond("Hi, @" + message["user_name"] + " On desk: " + " {}".format(time))
-#                    self.respond("{}".format(macaddr))
-                    self.respond("{}".format(hostname))
-#                    self.respond("{}".format(my_ip))
-                    self.respond("{}".format(stdout))
+#        if (macaddr.find("90b11c9d7834") != -1): # "0x90b11c9d7834" in macaddr or "0x180373202fcb" in macaddr:
+        self.respond("Hi, @" + message["user_name"] + " On desk: " + " {}".format(time))
+#        self.respond("{}".format(macaddr))
+        self.respond("{}".format(hostname))
+#        self.respond("{}".format(my_ip))
+        self.respond("{}".format(stdout))
+        if self.checkins is not None:
+            self.checkins.add(message["user_name"])
 #        else:
 #            self.respond("You're not on CATS desk location-Please login on desk")
-#        cur.execute('INSERT INTO checkin (name) VALUES ("testdb1")')
-        conn.commit()
-        conn.close
      
 
 
@@ -69,7 +67,9 @@ if __name__ == "__main__":
         password = cfg["password"]
 
     # Create the bot
-    bot = Jaxbot(domain, user, password)
+    # Jaxbot answers a checkin with several lines, send them as one message
+    bot = Jaxbot(domain, user, password, coalesce_responses=True,
+                 checkins=checkinstore.CheckinWriter(DSN))
 
     # Make the bot run
     bot.start()
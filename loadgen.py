@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import websocket
+
+import fakechat
+import rocketbot
+
+# Shift-change load test: the top of the hour, when a whole shift types
+# "checkin" at once.
+# Starts a fakechat.FakeRocketChat and a HelloBot or Jaxbot connected to
+# it, then has users staff members spread over rooms rooms each post one
+# "checkin", at times drawn from an arrival curve over window seconds:
+#   spike        everyone at once
+#   uniform      evenly over the window
+#   normal       bunched around the middle of the window
+#   exponential  most right away, tailing off
+# A reply is a message from the bot in the check-in's room that mentions
+# the user. It reports the check-in to reply latency distribution, check-ins
+# that got no reply (dropped) or more than one (duplicate), and the rows the
+# bot handed to its check-in writer.
+# Run with: python3 loadgen.py --bot hello --users 500 --rooms 20 --curve normal --window 5
+
+CURVES = ("spike", "uniform", "normal", "exponential")
+
+_MENTION = re.compile(r"@([\w.\-]+)")
+
+# Stands in for checkinstore.CheckinWriter when no database is given,
+# counting rows instead of writing them. There are no batches or
+# transactions to report, run with --dsn to see those.
+class CountingCheckinWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = []
+
+    def add(self, *values):
+        with self._lock:
+            self.rows.append(values)
+
+    def pending(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "pending": 0,
+            "rows_written": len(self.rows),
+        }
+
+# Seconds from the start of the run at which each of count users posts
+def arrival_times(curve, count, window, seed=None):
+    generator = random.Random(seed)
+    if curve == "spike":
+        times = [0.0] * count
+    elif curve == "uniform":
+        times = [generator.uniform(0, window) for _ in range(count)]
+    elif curve == "normal":
+        times = [min(max(generator.gauss(window / 2, window / 6), 0), window) for _ in range(count)]
+    elif curve == "exponential":
+        times = [min(generator.expovariate(4 / window), window) if window else 0.0 for _ in range(count)]
+    else:
+        raise AssertionError("Unknown arrival curve: {}".format(curve))
+    return sorted(times)
+
+# hello-bot.py isn't an importable module name
+def _load_hello_bot():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hello-bot.py")
+    spec = importlib.util.spec_from_file_location("hello_bot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_bot(kind, domain, checkins, **kwargs):
+    if kind == "jaxbot":
+        import deskfacts
+        import geolocate
+        import jaxbot
+        # No public IP lookups against the internet during a load test
+        facts = deskfacts.DeskFacts(refresh_in_background=False,
+                                    resolver=geolocate.PublicIPResolver(refresh_in_background=False))
+        return jaxbot.Jaxbot(domain, "jaxbot", "password", checkins=checkins, facts=facts,
+                             use_tls=False, **kwargs)
+    if kind == "hello":
+        return _load_hello_bot().HelloBot(domain, "hellobot", "password", checkins=checkins,
+                                          use_tls=False, **kwargs)
+    raise AssertionError("Unknown bot: {}".format(kind))
+
+# Matches bot replies to check-ins as the fake server receives them
+class _ReplyTracker:
+    def __init__(self, bot_user):
+        self.bot_user = bot_user
+        self._lock = threading.Lock()
+        # (room id, username) -> time posted
+        self.posted = {}
+        # (room id, username) -> [reply times]
+        self.replies = {}
+        self.other_messages = 0
+
+    def post(self, room_id, username, at):
+        with self._lock:
+            self.posted[(room_id, username)] = at
+
+    # fakechat listener, runs on the server thread
+    def on_message(self, message):
+        received = time.perf_counter()
+        if message["u"]["username"] != self.bot_user:
+            return
+        matched = False
+        with self._lock:
+            for username in _MENTION.findall(message["msg"]):
+                key = (message["rid"], username)
+                if key in self.posted:
+                    self.replies.setdefault(key, []).append(received)
+                    matched = True
+            if not matched:
+                self.other_messages += 1
+
+    def answered(self):
+        with self._lock:
+            return len(self.replies)
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+# Runs one shift change and returns the results. server_options go to
+# FakeRocketChat, bot_options to the bot. quiet turns the bot's logging
+# down to warnings, its per message INFO lines would swamp the run.
+def run_shift_change(bot="hello", users=200, rooms=10, curve="normal", window=5.0, drain=10.0,
+                     checkins=None, seed=None, server_options=None, bot_options=None, quiet=True):
+    server = fakechat.FakeRocketChat(rooms=rooms, seed=seed, **(server_options or {})).start()
+    writer = checkins if checkins is not None else CountingCheckinWriter()
+    chat_bot = make_bot(bot, server.domain, writer, **(bot_options or {}))
+    if quiet:
+        chat_bot.logger.setLevel(logging.WARNING)
+    tracker = _ReplyTracker(chat_bot.user)
+    server.add_listener(tracker.on_message)
+
+    bot_thread = threading.Thread(target=_run_bot, args=(chat_bot,), name="loadgen-bot", daemon=True)
+    bot_thread.start()
+    room_ids = [room["_id"] for room in server.joined_rooms()]
+    if not _wait_for(lambda: chat_bot.startup_seconds is not None, 30):
+        raise AssertionError("Bot didn't start")
+    if not _wait_for(lambda: all(server.is_subscribed(chat_bot.user, room_id) for room_id in room_ids), 30):
+        raise AssertionError("Bot didn't subscribe to every room")
+
+    # User i sits in room i % rooms
+    staff = [("staff{}".format(i), room_ids[i % len(room_ids)]) for i in range(users)]
+    times = arrival_times(curve, users, window, seed)
+    started = time.perf_counter()
+    for (username, room_id), offset in zip(staff, times):
+        wait = started + offset - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        tracker.post(room_id, username, time.perf_counter())
+        server.post_message(room_id, "checkin", username)
+    sent_seconds = time.perf_counter() - started
+    _wait_for(lambda: tracker.answered() >= users, drain)
+    # Give late duplicates a moment to show up
+    time.sleep(0.5)
+    elapsed = time.perf_counter() - started
+
+    writer.flush()
+    results = _results(tracker, writer, chat_bot, server, users, sent_seconds, elapsed)
+    chat_bot.reconnect = False
+    server.stop()
+    bot_thread.join(5)
+    return results
+
+# Runs the bot until the server goes away at the end of the run
+def _run_bot(chat_bot):
+    try:
+        chat_bot.start()
+    except (websocket.WebSocketException, OSError):
+        pass
+
+def _results(tracker, writer, chat_bot, server, users, sent_seconds, elapsed):
+    latencies = sorted(replies[0] - tracker.posted[key] for key, replies in tracker.replies.items())
+    duplicates = sum(len(replies) - 1 for replies in tracker.replies.values())
+    results = {
+        "checkins": users,
+        "send_seconds": sent_seconds,
+        "elapsed_seconds": elapsed,
+        "replied": len(latencies),
+        "dropped": users - len(latencies),
+        "duplicate_replies": duplicates,
+        "other_bot_messages": tracker.other_messages,
+        "db_rows": writer.stats()["rows_written"] + writer.pending(),
+        "db": writer.stats(),
+        "bot_sends": chat_bot.send_ack_stats(),
+        "server": dict(server.stats),
+    }
+    for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99), ("max_ms", 1.0)):
+        value = rocketbot._percentile(latencies, q)
+        results[name] = value * 1000 if value is not None else None
+    results["mean_ms"] = sum(latencies) * 1000 / len(latencies) if latencies else None
+    return results
+
+def print_results(results):
+    print("check-ins      {checkins} sent over {send_seconds:.2f}s, done after {elapsed_seconds:.2f}s".format(**results))
+    print("replies        {replied} replied, {dropped} dropped, {duplicate_replies} duplicate, "
+          "{other_bot_messages} other bot messages".format(**results))
+    if results["replied"]:
+        print("reply latency  p50 {p50_ms:.1f}ms  p90 {p90_ms:.1f}ms  p99 {p99_ms:.1f}ms  "
+              "max {max_ms:.1f}ms  mean {mean_ms:.1f}ms".format(**results))
+    print("db writes      {} rows, {}".format(results["db_rows"], results["db"]))
+    print("bot sends      {}".format(results["bot_sends"]))
+    print("server         {}".format(results["server"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Shift-change check-in burst against a fake Rocket.Chat")
+    parser.add_argument("--bot", choices=("hello", "jaxbot"), default="hello")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--curve", choices=CURVES, default="normal")
+    parser.add_argument("--window", type=float, default=5.0, help="seconds the arrivals are spread over")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to wait for the last replies")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0, help="server side latency per frame, seconds")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--drop", type=float, default=0, help="fraction of server frames to drop")
+    parser.add_argument("--background-rate", type=float, default=0, help="other chat messages per second")
+    parser.add_argument("--chat-workers", type=int, default=0)
+    parser.add_argument("--send-rate", type=float, default=None)
+    parser.add_argument("--coalesce", action="store_true", help="coalesce_responses, like Jaxbot's main")
+    parser.add_argument("--single-subscription", action="store_true")
+    parser.add_argument("--dsn", help="write check-ins to this Postgres database instead of counting them")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    checkins = None
+    if args.dsn:
+        import checkinstore
+        checkins = checkinstore.CheckinWriter(args.dsn)
+    bot_options = {
+        "chat_workers": args.chat_workers,
+        "send_rate": args.send_rate,
+        "coalesce_responses": args.coalesce,
+        "single_subscription": args.single_subscription,
+    }
+    server_options = {
+        "latency": args.latency,
+        "latency_jitter": args.jitter,
+        "drop_rate": args.drop,
+        "message_rate": args.background_rate,
+    }
+    results = run_shift_change(args.bot, args.users, args.rooms, args.curve, args.window, args.drain,
+                               checkins, args.seed, server_options, bot_options, quiet=not args.verbose)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == "__main__":
+    main()
@@ -28,9 +28,11 @@ import subprocess
 
 #subprocess.call("ip addr show ens3 | grep 'inet' | awk '{print $2}' | cut -f1 -d'/' ", shell = True)
 
-process = subprocess.Popen(["ip addr show ens3 | grep 'inet ' | awk '{print $2}' | cut -f1 -d'/'"],shell = True, stdout=subprocess.PIPE)
-stdout = process.communicate()[0]
-print('IP:{}'.format(stdout))
+#process = subprocess.Popen(["ip addr show ens3 | grep 'inet ' | awk '{print $2}' | cut -f1 -d'/'"],shell = True, stdout=subprocess.PIPE)
+#stdout = process.communicate()[0]
+import netinfo
+
+print('IP:{}'.format(netinfo.ipv4_addresses('ens3')))
 
 
 
@@ -0,0 +1,130 @@
+import http.server
+import logging
+import threading
+
+# Prometheus metrics for a WebsocketRocketBot.
+# render() writes the text exposition format (version 0.0.4), MetricsServer
+# serves it on http://<host>:<port>/metrics from a daemon thread, so the bot
+# can be scraped like any other service. Everything is read from counters
+# the bot keeps anyway, a scrape doesn't touch the hot path.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render(bot):
+    lines = []
+    _metric(lines, "rocketbot_logged_in", "gauge",
+            "1 while the bot is connected and logged in",
+            [({}, int(bool(bot.logged_in)))])
+    _metric(lines, "rocketbot_frames_received_total", "counter",
+            "Websocket frames received",
+            [({}, bot.frames_received)])
+    _metric(lines, "rocketbot_frames_sent_total", "counter",
+            "Websocket frames sent",
+            [({}, bot.frames_sent)])
+    filter_stats = bot.filter_stats()
+    passed = filter_stats.pop("passed")
+    _metric(lines, "rocketbot_messages_filtered_total", "counter",
+            "Chat messages dropped before the handler, by filter",
+            [({"reason": name}, count) for name, count in filter_stats.items()])
+    _metric(lines, "rocketbot_messages_passed_total", "counter",
+            "Chat messages that got through every filter",
+            [({}, passed)])
+    _histogram(lines, "rocketbot_message_stage_seconds",
+               "Time chat messages spend in each stage, see RocketBot.LATENCY_STAGES",
+               [({"stage": stage}, bot._latency[stage]) for stage in bot.LATENCY_STAGES if stage in bot._latency])
+    _histogram(lines, "rocketbot_rest_request_seconds",
+               "REST api call latency by endpoint",
+               [({"endpoint": endpoint}, histogram) for endpoint, histogram in sorted(bot._rest_latency.items())])
+    _metric(lines, "rocketbot_reconnects_total", "counter",
+            "Times the connection was lost and reopened",
+            [({}, bot.reconnects)])
+    _metric(lines, "rocketbot_pending_method_calls", "gauge",
+            "DDP method calls waiting for their result",
+            [({}, bot.pending_call_count())])
+    _metric(lines, "rocketbot_outbound_queue_depth", "gauge",
+            "Messages waiting on the send rate limiter",
+            [({}, bot.outbound_queue_depth())])
+    _metric(lines, "rocketbot_rooms", "gauge",
+            "Rooms the bot is subscribed to",
+            [({}, len(bot.room_list_by_id))])
+    _metric(lines, "rocketbot_sends_total", "counter",
+            "sendMessage calls by outcome",
+            [({"result": "acked"}, bot.sends_acked), ({"result": "failed"}, bot.sends_failed)])
+    _metric(lines, "rocketbot_send_retries_total", "counter",
+            "sendMessage calls sent again after a timeout or rate limit",
+            [({}, bot.sends_retried)])
+    return "\n".join(lines) + "\n"
+
+def _metric(lines, name, kind, help_text, samples):
+    lines.append("# HELP {} {}".format(name, help_text))
+    lines.append("# TYPE {} {}".format(name, kind))
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, _labels(labels), value))
+
+# samples are (labels, rocketbot.LatencyHistogram) pairs
+def _histogram(lines, name, help_text, samples):
+    lines.append("# HELP {} {}".format(name, help_text))
+    lines.append("# TYPE {} histogram".format(name))
+    for labels, histogram in samples:
+        buckets, count, total = histogram.snapshot()
+        cumulative = 0
+        for bound, bucket in zip(histogram.BOUNDS, buckets):
+            cumulative += bucket
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, le="{:.6g}".format(bound)), cumulative))
+        lines.append("{}_bucket{} {}".format(name, _labels(labels, le="+Inf"), count))
+        lines.append("{}_sum{} {!r}".format(name, _labels(labels), total))
+        lines.append("{}_count{} {}".format(name, _labels(labels), count))
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels.items()) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Serves render(bot) on /metrics. port 0 picks a free port, see .port
+class MetricsServer:
+    def __init__(self, bot, port, host="0.0.0.0"):
+        self.bot = bot
+        self.logger = logging.getLogger(__name__)
+        self._server = http.server.ThreadingHTTPServer((host, port), self._request_handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self.logger.info("Serving metrics on port {}".format(self.port))
+        self._thread = threading.Thread(target=self._server.serve_forever, name="rocketbot-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _request_handler(self):
+        server = self
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(server.bot).encode("utf-8")
+                except Exception as e:
+                    server.logger.error("Error rendering metrics: {}".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes go to the debug log instead of stderr
+            def log_message(self, format, *args):
+                server.logger.debug(format, *args)
+
+        return MetricsRequestHandler
@@ -0,0 +1,150 @@
+import collections
+import fcntl
+import os
+import socket
+import struct
+
+# Network interface information read straight from the kernel, without
+# forking `ip`/`ifconfig`. Addresses come from an rtnetlink RTM_GETADDR
+# dump (all IPv4 and IPv6 addresses, secondaries included), falling back
+# to the SIOCGIFADDR ioctl (primary IPv4 address only) where netlink isn't
+# available. MACs and link state come from sysfs, or SIOCGIFHWADDR.
+
+Interface = collections.namedtuple("Interface", ["name", "index", "mac", "up", "ipv4", "ipv6"])
+Address = collections.namedtuple("Address", ["address", "prefixlen"])
+
+_SYS_NET = "/sys/class/net"
+
+# rtnetlink constants, see linux/netlink.h, linux/rtnetlink.h, linux/if_addr.h
+_NETLINK_ROUTE = 0
+_RTM_NEWADDR = 20
+_RTM_GETADDR = 22
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NLM_F_REQUEST = 0x1
+_NLM_F_DUMP = 0x300
+_IFA_ADDRESS = 1
+_IFA_LOCAL = 2
+
+# ioctl numbers, see linux/sockios.h
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+_SIOCGIFHWADDR = 0x8927
+
+# All interfaces by name
+def interfaces():
+    addresses = _netlink_addresses()
+    result = {}
+    for index, name in socket.if_nameindex():
+        if addresses is None:
+            ipv4 = _ioctl_ipv4(name)
+            ipv6 = []
+        else:
+            ipv4 = addresses.get((index, socket.AF_INET), [])
+            ipv6 = addresses.get((index, socket.AF_INET6), [])
+        result[name] = Interface(name, index, mac_address(name), _is_up(name), ipv4, ipv6)
+    return result
+
+# One interface, or None if there's no such interface
+def interface(name):
+    return interfaces().get(name)
+
+# IPv4 addresses of an interface as strings, like
+# `ip addr show <name> | grep 'inet ' | awk '{print $2}' | cut -f1 -d'/'`
+def ipv4_addresses(name):
+    try:
+        index = socket.if_nametoindex(name)
+    except OSError:
+        return []
+    addresses = _netlink_addresses(socket.AF_INET)
+    if addresses is None:
+        return [address.address for address in _ioctl_ipv4(name)]
+    return [address.address for address in addresses.get((index, socket.AF_INET), [])]
+
+# MAC address as "aa:bb:cc:dd:ee:ff", None if the interface has none
+def mac_address(name):
+    try:
+        with open(os.path.join(_SYS_NET, name, "address")) as address_file:
+            mac = address_file.read().strip()
+    except OSError:
+        mac = _ioctl_mac(name)
+    if not mac or mac == "00:00:00:00:00:00":
+        return None
+    return mac
+
+def _is_up(name):
+    try:
+        with open(os.path.join(_SYS_NET, name, "operstate")) as state_file:
+            return state_file.read().strip() in ("up", "unknown")
+    except OSError:
+        return None
+
+# {(interface index, family): [Address]}, None if netlink isn't available
+def _netlink_addresses(family=socket.AF_UNSPEC):
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+    except (AttributeError, OSError):
+        return None
+    addresses = {}
+    with sock:
+        sock.bind((0, 0))
+        # nlmsghdr followed by ifaddrmsg
+        request = struct.pack("=IHHIIBBBBI", 16 + 8, _RTM_GETADDR, _NLM_F_REQUEST | _NLM_F_DUMP, 1, 0,
+                              family, 0, 0, 0, 0)
+        sock.sendto(request, (0, 0))
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, msg_type, flags, seq, pid = struct.unpack_from("=IHHII", data, offset)
+                if length < 16:
+                    return addresses
+                if msg_type == _NLMSG_DONE:
+                    return addresses
+                if msg_type == _NLMSG_ERROR:
+                    return None
+                if msg_type == _RTM_NEWADDR:
+                    _parse_newaddr(data, offset, length, addresses)
+                offset += (length + 3) & ~3
+
+def _parse_newaddr(data, offset, length, addresses):
+    family, prefixlen, flags, scope, index = struct.unpack_from("=BBBBI", data, offset + 16)
+    attributes = {}
+    position = offset + 16 + 8
+    end = offset + length
+    while position + 4 <= end:
+        attr_length, attr_type = struct.unpack_from("=HH", data, position)
+        if attr_length < 4:
+            break
+        attributes[attr_type] = data[position + 4:position + attr_length]
+        position += (attr_length + 3) & ~3
+    # On point to point links IFA_ADDRESS is the peer, IFA_LOCAL is ours
+    raw = attributes.get(_IFA_LOCAL, attributes.get(_IFA_ADDRESS))
+    if raw is None or family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    address = Address(socket.inet_ntop(family, raw), prefixlen)
+    addresses.setdefault((index, family), []).append(address)
+
+def _ioctl_ipv4(name):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        request = struct.pack("256s", name.encode("utf-8")[:15])
+        try:
+            address = fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, request)[20:24]
+            netmask = fcntl.ioctl(sock.fileno(), _SIOCGIFNETMASK, request)[20:24]
+        except OSError:
+            return []
+    prefixlen = bin(struct.unpack("!I", netmask)[0]).count("1")
+    return [Address(socket.inet_ntoa(address), prefixlen)]
+
+def _ioctl_mac(name):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        request = struct.pack("256s", name.encode("utf-8")[:15])
+        try:
+            hwaddr = fcntl.ioctl(sock.fileno(), _SIOCGIFHWADDR, request)[18:24]
+        except OSError:
+            return None
+    return ":".join("{:02x}".format(byte) for byte in hwaddr)
+
+if __name__ == "__main__":
+    for interface_info in interfaces().values():
+        print(interface_info)
@@ -1,21 +1,508 @@
+import asyncio
+import base64
+import bisect
+import contextvars
 import hashlib
+import heapq
 import io
 import json
 import logging
+import metrics
+import random
 import re
 import requests
 import sys
+import threading
+import time
 import uuid
 import websocket
 import traceback
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Channel of the message currently being handled. Handlers that run
+# concurrently (threads, tasks) each see the channel they were started for,
+# so respond() replies to the right room.
+_current_channel = contextvars.ContextVar("rocketbot_current_channel", default=None)
+
+# JSON codecs used for websocket frames and REST payloads.
+# loads() takes str or bytes, dumps() returns str (DDP wants text frames).
+class JsonCodec:
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+    def dumps(self, value):
+        return self._orjson.dumps(value).decode("utf-8")
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+    def dumps(self, value):
+        return self._ujson.dumps(value, escape_forward_slashes=False)
+
+_CODECS = {
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+    "json": JsonCodec,
+}
+
+# Returns the named codec, or the fastest one that is installed
+def get_codec(name=None):
+    if name is not None:
+        return _CODECS[name]()
+    for codec_class in (OrjsonCodec, UjsonCodec):
+        try:
+            return codec_class()
+        except ImportError:
+            pass
+    return JsonCodec()
+
+# Responses collected during one handler call when coalescing is on,
+# as [channel, [texts], attachments] entries
+_response_batch = contextvars.ContextVar("rocketbot_response_batch", default=None)
+
+# MessageTimings of the chat message currently being handled
+_current_timings = contextvars.ContextVar("rocketbot_current_timings", default=None)
+
+# Timestamps (time.perf_counter()) a chat message picks up on its way
+# through the bot. queued adds up the seconds it spent waiting for a
+# worker thread or handler slot.
+class MessageTimings:
+    __slots__ = ("received", "parsed", "dispatched", "filtered", "queued")
+
+    def __init__(self, received, parsed, dispatched):
+        self.received = received
+        self.parsed = parsed
+        self.dispatched = dispatched
+        self.filtered = None
+        self.queued = 0.0
+
+# Latency histogram with fixed log scale buckets. Recording is O(log
+# buckets) and the memory use doesn't grow with the number of samples,
+# percentiles are the upper bound of the bucket they fall in.
+class LatencyHistogram:
+    # Bucket upper bounds in seconds, 10us doubling up to about 5.6 minutes.
+    # Anything slower lands in an extra overflow bucket.
+    BOUNDS = tuple(0.00001 * 2 ** i for i in range(26))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        index = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    # Seconds at quantile q (0-1), None without samples
+    def percentile(self, q):
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, int(q * self.count + 0.5))
+            seen = 0
+            for index, count in enumerate(self.buckets):
+                seen += count
+                if seen >= rank:
+                    break
+            if index == len(self.BOUNDS):
+                return self.max
+            return min(self.BOUNDS[index], self.max)
+
+    # (per bucket counts, count, sum of seconds), all from the same moment
+    def snapshot(self):
+        with self._lock:
+            return list(self.buckets), self.count, self.total
+
+    def stats(self):
+        stats = {
+            "count": self.count,
+            "avg_ms": self.total * 1000 / self.count if self.count else None,
+        }
+        for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+            value = self.percentile(q)
+            stats[name] = value * 1000 if value is not None else None
+        stats["max_ms"] = self.max * 1000
+        return stats
+
+# Log argument that only serializes to JSON when the record is formatted,
+# so debug logging on the hot path costs nothing when DEBUG is off
+class _LazyJson:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value)
+
+# Runs work on a thread pool, keeping work submitted under the same key
+# (a room id) in order while different keys run in parallel.
+# submit() blocks once max_pending items are waiting, which pushes back
+# on the caller instead of queueing without bound.
+class KeyedSerialExecutor:
+    def __init__(self, max_workers, max_pending=1000, thread_name_prefix="rocketbot-worker"):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, key, fn, *args):
+        self._slots.acquire()
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([(fn, args)])
+                self._pool.submit(self._run_next, key)
+            else:
+                queue.append((fn, args))
+
+    # Run one item for the key, then go to the back of the pool's queue
+    # so one busy room can't starve the others
+    def _run_next(self, key):
+        with self._lock:
+            fn, args = self._queues[key][0]
+        try:
+            fn(*args)
+        finally:
+            self._slots.release()
+            with self._lock:
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    self._pool.submit(self._run_next, key)
+                else:
+                    del self._queues[key]
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+# Token bucket: allows rate events per second on average and bursts of
+# up to burst events
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Seconds until a token is available, 0 if one is available now
+    def delay(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+# Outbound queue with one token bucket per room. Frames for one room go
+# out in order, a room that is over its rate only holds up itself.
+# A single daemon thread does the sending through send(frame) and then
+# calls the frame's on_sent callback, if it has one.
+class RateLimitedSender:
+    def __init__(self, send, rate, burst, logger=None):
+        self._send = send
+        self._rate = rate
+        self._burst = burst
+        self._logger = logger or logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._buckets = {}
+        self._depth = 0
+        self.frames_sent = 0
+        self._thread = threading.Thread(target=self._run, name="rocketbot-sender", daemon=True)
+        self._thread.start()
+
+    def put(self, key, frame, on_sent=None):
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append((frame, on_sent))
+            self._depth += 1
+            self._cond.notify()
+
+    def depth(self):
+        return self._depth
+
+    # Take every frame that has a token right now, or wait for the
+    # soonest token (or a new frame)
+    def _next_frames(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready = []
+                wait = None
+                for key in list(self._queues):
+                    bucket = self._buckets.get(key)
+                    if bucket is None:
+                        bucket = self._buckets[key] = TokenBucket(self._rate, self._burst)
+                    delay = bucket.delay(now)
+                    if delay == 0:
+                        bucket.take()
+                        queue = self._queues[key]
+                        ready.append(queue.popleft())
+                        if not queue:
+                            del self._queues[key]
+                    elif wait is None or delay < wait:
+                        wait = delay
+                if ready:
+                    self._depth -= len(ready)
+                    return ready
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            for frame, on_sent in self._next_frames():
+                try:
+                    self._send(frame)
+                    self.frames_sent += 1
+                    if on_sent is not None:
+                        on_sent()
+                except Exception as e:
+                    self._logger.error("Error sending queued frame: {}".format(e))
+
+# Value at quantile q (0-1) of an already sorted list
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+# Raised through a call_method() future when the server answers with an error
+class MethodCallError(Exception):
+    def __init__(self, method, error):
+        super().__init__("{} failed: {}".format(method, error))
+        self.method = method
+        self.error = error
+
+# A Future whose result is set on the bot's receive thread. Waiting on
+# one from that same thread (an inline handler) could never finish, the
+# thread can't read the answer while it waits, so result() and
+# exception() raise AssertionError there instead of blocking.
+# receive_thread returns the thread that reads the socket, or None.
+class CallFuture(Future):
+    def __init__(self, receive_thread):
+        super().__init__()
+        self._receive_thread = receive_thread
+
+    def result(self, timeout=None):
+        self._check_wait()
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        self._check_wait()
+        return super().exception(timeout)
+
+    def _check_wait(self):
+        if not self.done() and threading.current_thread() is self._receive_thread():
+            raise AssertionError("Waiting on a method call from the bot's receive thread would block forever, "
+                                 "use add_done_callback(), chat_workers or AsyncWebsocketRocketBot.call()")
+
+# Outstanding DDP method calls by id. Each call gets a Future that is
+# resolved when its result arrives, fails with TimeoutError when its
+# timeout runs out first, and leaves the table either way.
+# receive_thread is passed on to each call's CallFuture.
+class PendingCalls:
+    def __init__(self, max_pending=1000, receive_thread=lambda: None):
+        self.max_pending = max_pending
+        self._receive_thread = receive_thread
+        self._cond = threading.Condition()
+        self._calls = {}
+        self._deadlines = []
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._calls)
+
+    def add(self, id, method, timeout=None):
+        future = CallFuture(self._receive_thread)
+        with self._cond:
+            if len(self._calls) >= self.max_pending:
+                raise AssertionError("Too many pending method calls ({})".format(len(self._calls)))
+            self._calls[id] = (future, method)
+            if timeout is not None:
+                self._push_deadline(id, timeout)
+        # A caller that gives up on the future frees its slot right away
+        future.add_done_callback(lambda f: self._discard(id) if f.cancelled() else None)
+        return future
+
+    # Starts the timeout of a call added without one, e.g. once its frame
+    # has actually been written. Does nothing if the call is already over.
+    def start_timeout(self, id, timeout):
+        with self._cond:
+            if id in self._calls:
+                self._push_deadline(id, timeout)
+
+    # Called with _cond held
+    def _push_deadline(self, id, timeout):
+        heapq.heappush(self._deadlines, (time.monotonic() + timeout, id))
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._expire, name="rocketbot-calls", daemon=True)
+            self._reaper.start()
+        self._cond.notify()
+
+    # Resolves the call the result answers. Returns False if it isn't ours.
+    def resolve(self, message):
+        with self._cond:
+            call = self._calls.pop(message.get("id"), None)
+        if call is None:
+            return False
+        future, method = call
+        if future.set_running_or_notify_cancel():
+            if "error" in message:
+                future.set_exception(MethodCallError(method, message["error"]))
+            else:
+                future.set_result(message.get("result"))
+        return True
+
+    # Fails every outstanding call, their results won't arrive anymore
+    def fail_all(self, e):
+        with self._cond:
+            calls = list(self._calls.values())
+            self._calls.clear()
+            self._deadlines.clear()
+        for future, method in calls:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+
+    def _discard(self, id):
+        with self._cond:
+            self._calls.pop(id, None)
+
+    def _expire(self):
+        while True:
+            with self._cond:
+                while not self._deadlines or self._deadlines[0][0] > time.monotonic():
+                    wait = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+                    self._cond.wait(wait)
+                deadline, id = heapq.heappop(self._deadlines)
+                call = self._calls.pop(id, None)
+            if call is not None:
+                future, method = call
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(TimeoutError("{} timed out".format(method)))
+
+# Routes chat messages to command handlers by trigger word.
+# All triggers are compiled into one regex, factored as a trie so shared
+# prefixes are only tried once, and each message is lowercased and scanned
+# a single time however many commands there are. Like the old
+# `"checkin" in text.lower()` checks, a trigger matches anywhere in the
+# text. The leftmost trigger wins, the longest one if several start there.
+class CommandRouter:
+    def __init__(self):
+        self._handlers = {}
+        self._pattern = None
+
+    def add(self, trigger, handler):
+        self._handlers[trigger.lower()] = handler
+        self._pattern = None
+
+    # Decorator form of add()
+    def command(self, *triggers):
+        def register(handler):
+            for trigger in triggers:
+                self.add(trigger, handler)
+            return handler
+        return register
+
+    def __len__(self):
+        return len(self._handlers)
+
+    # (trigger, handler) for the first command in text, or None
+    def match(self, text):
+        if not self._handlers:
+            return None
+        if self._pattern is None:
+            self._pattern = re.compile(self._trie_regex(sorted(self._handlers)))
+        # Lowercasing up front is much cheaper than re.IGNORECASE
+        found = self._pattern.search(text.lower())
+        if found is None:
+            return None
+        trigger = found.group(0)
+        return trigger, self._handlers[trigger]
+
+    # Calls the handler for the message's command. Returns False if there's none.
+    def dispatch(self, message):
+        matched = self.match(message["text"])
+        if matched is None:
+            return False
+        matched[1](message)
+        return True
+
+    # Regex for a sorted list of words, longest alternative first at each level
+    def _trie_regex(self, words):
+        branches = {}
+        ends_here = False
+        for word in words:
+            if word:
+                branches.setdefault(word[0], []).append(word[1:])
+            else:
+                ends_here = True
+        alternatives = [re.escape(char) + self._trie_regex(rest) for char, rest in sorted(branches.items())]
+        if not alternatives:
+            return ""
+        regex = alternatives[0] if len(alternatives) == 1 else "(?:{})".format("|".join(alternatives))
+        if ends_here:
+            regex = "(?:{})?".format(regex)
+        return regex
+
 # Base Class for Rocket.chat Bots
 # You probably don't want to subclass this directly,
 # You probably want to subclass
 # WebsocketRocketBot or CGIRocketBot
 class RocketBot:
-    def __init__(self, user):
+    # codec is a JsonCodec, a codec name ("orjson", "ujson", "json") or None
+    # to pick the fastest one installed
+    def __init__(self, user, codec=None):
         self.user = user
+        if codec is None or isinstance(codec, str):
+            codec = get_codec(codec)
+        self.codec = codec
+        self.commands = CommandRouter()
+        # Built from message_filters() on the first message
+        self._filters = None
+        # Filters run on chat_workers threads too, the counts move under
+        # _filter_lock
+        self._filter_lock = threading.Lock()
+        self._filter_drops = {}
+        self.messages_passed = 0
+        # Stage name -> LatencyHistogram
+        self._latency = {}
 
         # Setup logging
         self.logger = logging.getLogger(__name__)
@@ -29,41 +516,125 @@ class RocketBot:
         self.logger.addHandler(stderr_logger)
 
     # Your main work function. Called whenever your bot gets a new message
-    # in a channel it's in.
+    # in a channel it's in. By default it hands the message to the command
+    # registered in self.commands for the trigger found in its text.
     def handle_chat_message(self, message):
-        self.logger.warning("Unhandled chat message: {}".format(message))
+        if not self.commands.dispatch(message):
+            self.logger.warning("Unhandled chat message: {}".format(message))
+
+    # The filters every chat message goes through before handle_chat_message,
+    # as an ordered list of (name, test) pairs. A message is dropped by the
+    # first test that returns True. Cheap tests go first. Subclasses extend
+    # the list by overriding this and adding to super().message_filters().
+    def message_filters(self):
+        return [
+            ("self", self._filter_self),
+            ("bot", self._filter_bot),
+            ("reactions", self._filter_reactions),
+            ("url_preview", self._filter_url_preview),
+            ("mention_update", self._filter_mention_update),
+        ]
 
-    # Filters out message from yourself before
+    def _filter_self(self, message):
+        return message.get('user_name') == self.user
+
+    def _filter_bot(self, message):
+        return bool(message.get('bot'))
+
+    # Message updated by reactions
+    def _filter_reactions(self, message):
+        raw = message.get('_rawMessage')
+        return raw is not None and bool(raw.get('reactions'))
+
+    # Message updated with a URL preview
+    def _filter_url_preview(self, message):
+        raw = message.get('_rawMessage')
+        if raw is None:
+            return False
+        urls = raw.get('urls')
+        return bool(urls) and bool(urls[0].get('meta'))
+
+    # Message updated from @Username
+    def _filter_mention_update(self, message):
+        raw = message.get('_rawMessage')
+        if raw is None:
+            return False
+        updated = raw.get('_updatedAt')
+        timestamp = message.get('timestamp')
+        if updated is None or timestamp is None or '$date' not in updated:
+            return False
+        # The biggest difference I saw in a not updated message is 58
+        return (updated['$date'] - timestamp) > 200
+
+    # Runs the filters before
     # passing messages onto the handle_chat_message
     # handler
     def _handle_chat_message(self, message):
-        try:
-            if message['_rawMessage']['reactions']:
-                self.logger.debug("Filtering out message updated by reactions")
-                return
-        except KeyError:
-            pass
-        try:
-            if message['_rawMessage']['urls'][0]['meta']:
-                self.logger.debug("Filtering out message URL preview")
-                return
-        except KeyError:
-            pass
-        try:
-            # The biggest difference I saw in a not updated message is 58
-            if (message['_rawMessage']['_updatedAt']['$date'] - message['timestamp']) > 200:
-                self.logger.debug("Filtering out message from @Username update")
+        timings = _current_timings.get()
+        if timings is not None:
+            started = time.perf_counter()
+            timings.queued += started - timings.dispatched
+        filters = self._filters
+        if filters is None:
+            filters = self._filters = self.message_filters()
+        for name, test in filters:
+            if test(message):
+                with self._filter_lock:
+                    self._filter_drops[name] = self._filter_drops.get(name, 0) + 1
+                self.logger.debug("Filtering out message (%s)", name)
+                if timings is not None:
+                    self._record_latency("filter", time.perf_counter() - started)
                 return
-        except KeyError:
-            pass
-        if message['user_name'] == self.user:
-            self.logger.debug("Filtering out message from self")
-            return
-        elif message['bot']:
-            self.logger.debug("Filtering out message from known bot")
-            return
-        else:
-            self.handle_chat_message(message)
+        with self._filter_lock:
+            self.messages_passed += 1
+        if timings is not None:
+            timings.filtered = time.perf_counter()
+            self._record_latency("filter", timings.filtered - started)
+        self._run_handler(self.handle_chat_message, message)
+
+    # How many messages each filter dropped, and how many got through
+    def filter_stats(self):
+        filters = self._filters or self.message_filters()
+        with self._filter_lock:
+            stats = {name: self._filter_drops.get(name, 0) for name, test in filters}
+            stats["passed"] = self.messages_passed
+        return stats
+
+    # Stages of a chat message's trip through the bot that get timed:
+    # recv      server timestamp to frame read off the socket (includes
+    #           any clock difference between server and bot)
+    # parse     frame read to JSON decoded
+    # dispatch  decoded to routed and turned into a chat message
+    # filter    running message_filters()
+    # queue     waiting for a worker thread or handler slot
+    # handler   running handle_chat_message
+    # send      respond()/send_message() to the frame being written, rate
+    #           limiter wait included
+    # total     frame read to reply written
+    LATENCY_STAGES = ("recv", "parse", "dispatch", "filter", "queue", "handler", "send", "total")
+
+    def _record_latency(self, stage, seconds):
+        histogram = self._latency.get(stage)
+        if histogram is None:
+            histogram = self._latency.setdefault(stage, LatencyHistogram())
+        histogram.record(seconds)
+
+    # Per stage latency stats, in ms, for every stage that has samples
+    def latency_stats(self):
+        return {stage: self._latency[stage].stats() for stage in self.LATENCY_STAGES if stage in self._latency}
+
+    # latency_stats() as one line per stage, for the log
+    def latency_summary(self):
+        lines = []
+        for stage, stats in self.latency_stats().items():
+            lines.append("{:<8} n={:<8} p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+                stage, stats["count"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["max_ms"]))
+        return "\n".join(lines)
+
+    # Calls one of the overridable handlers. Subclasses that change where
+    # handlers run (threads, event loops) hook in here.
+    def _run_handler(self, handler, message):
+        handler(message)
 
     # Respond to the incoming message
     def respond(self, text, attachments = None, channel = None):
@@ -81,44 +652,165 @@ class RocketBot:
 # Web socket based RocketBot
 # Unless you known otherwise, this is probably what you want to subclass
 class WebsocketRocketBot(RocketBot):
-    def __init__(self, domain, user, password, raise_exceptions=False):
-        super().__init__(user)
+    # chat_workers > 0 hands chat messages to a pool of that many threads.
+    # Messages from one room are still handled in order, different rooms
+    # are handled in parallel.
+    # REST calls share one keep-alive session holding up to rest_pool_size
+    # connections, rest_timeout is passed to requests as (connect, read).
+    # When the connection drops the bot reconnects after a jittered,
+    # exponentially growing delay between reconnect_min_delay and
+    # reconnect_max_delay seconds, unless reconnect is False.
+    # single_subscription subscribes once to __my_messages__ (every room the
+    # user is in) instead of once per room, frames are routed by room id.
+    # send_rate (messages per second per room, bursts of send_burst) puts
+    # outgoing messages on a rate limited queue instead of sending inline.
+    # coalesce_responses merges back to back respond() calls to the same
+    # room from one handler call into a single message.
+    # latency_log_interval logs latency_summary() every that many seconds.
+    # metrics_port serves Prometheus metrics over HTTP on that port
+    # (see metrics.py), metrics_host is the address to listen on.
+    # capture_path appends every raw inbound frame to that file as a JSON
+    # line {"t": unix time, "frame": frame text}, for replaying it with
+    # bench.py later. Binary frames are stored as "frame_b64" instead.
+    # use_tls=False talks ws:// and http:// instead of wss:// and https://,
+    # for servers without TLS such as fakechat.py.
+    def __init__(self, domain, user, password, raise_exceptions=False,
+                 chat_workers=0, max_pending_chat_messages=1000,
+                 rest_pool_size=4, rest_timeout=(5, 30), codec=None,
+                 reconnect=True, reconnect_min_delay=1, reconnect_max_delay=60,
+                 single_subscription=False, send_rate=None, send_burst=5,
+                 coalesce_responses=False, max_pending_calls=1000,
+                 send_ack_timeout=10, send_retries=2, latency_log_interval=None,
+                 metrics_port=None, metrics_host="0.0.0.0", capture_path=None,
+                 use_tls=True):
+        super().__init__(user, codec)
         self.domain = domain
-        self.web_socket_address="wss://{}/websocket".format(domain)
+        self.web_socket_address="{}://{}/websocket".format("wss" if use_tls else "ws", domain)
+        self.rest_address = "{}://{}".format("https" if use_tls else "http", domain)
         self.passhash = hashlib.sha256(password.encode('utf-8')).hexdigest()
         self.raise_exceptions = raise_exceptions
         self.logged_in = False
         self.login_id = str(uuid.uuid4())
-        self._room_requests = {}
+        self.user_id = None
+        self.user_token = None
+        self._resuming = False
+        self._rooms_discovered = False
+        self.reconnect = reconnect
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnects = 0
+        self._reconnect_attempt = 0
+        self.single_subscription = single_subscription
+        self.coalesce_responses = coalesce_responses
+        self._outbox = None
+        if send_rate is not None:
+            self._outbox = RateLimitedSender(self._send_frame,
+                                             send_rate, send_burst, self.logger)
+        # Seconds from connect to bot_ready()/bot_reconnected()
+        self._connect_started = None
+        self.startup_seconds = None
+        self.reconnect_seconds = None
+        # The thread call results arrive on, see CallFuture
+        self._receive_thread = None
+        self._pending_calls = PendingCalls(max_pending_calls, lambda: self._receive_thread)
+        # sendMessage calls are tracked until the server acks them and
+        # resent (with the same message _id) up to send_retries times
+        self.send_ack_timeout = send_ack_timeout
+        self.send_retries = send_retries
+        self._ack_latencies = deque(maxlen=1000)
+        self._unacked_sends = []
+        self.sends_acked = 0
+        self.sends_retried = 0
+        self.sends_failed = 0
         # Joined room list and all rooms
         self.room_list = {}
         self.all_room_list = {}
         self.room_list_by_id = {}
         self.all_room_list_by_id = {}
+        # DM room id -> _catName, so room events don't need im.list
+        self._dm_names_by_id = {}
+        self._last_message_channel = None
+        self._routes = {}
+        self._route_stats = {}
+        self._add_default_routes()
+        self._chat_executor = None
+        if chat_workers > 0:
+            self._chat_executor = KeyedSerialExecutor(chat_workers,
+                                                      max_pending=max_pending_chat_messages,
+                                                      thread_name_prefix="rocketbot-chat")
+        self.rest_timeout = rest_timeout
+        # Rocket.Chat caps count at 100 unless the server says otherwise
+        self.rest_page_size = 100
+        self._rest_calls = 0
+        # REST endpoint path -> LatencyHistogram
+        self._rest_latency = {}
+        self._rest_session = requests.Session()
+        self._rest_adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                           pool_maxsize=rest_pool_size)
+        self._rest_session.mount("https://" if use_tls else "http://", self._rest_adapter)
+        self.frames_received = 0
+        self.frames_sent = 0
+        # When the frame being dispatched was read and decoded
+        self._frame_received_at = None
+        self._frame_parsed_at = None
+        self.latency_log_interval = latency_log_interval
+        if latency_log_interval:
+            self._latency_logger = threading.Thread(target=self._log_latency, name="rocketbot-latency", daemon=True)
+            self._latency_logger.start()
+        self._capture = None
+        if capture_path is not None:
+            self._capture = open(capture_path, "a", encoding="utf-8", buffering=1)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self, metrics_port, metrics_host)
+            self.metrics_server.start()
 
-    # Filters out previously read messages before passing
-    # messages on to the generic _handle_chat_message method
-    def _handle_chat_message(self, message):
-        if "unread" in message["_rawMessage"]:
-            super()._handle_chat_message(message)
-        else:
-            self.logger.debug("Filtering out known read message")
-            return
+    # Also filters out previously read messages
+    def message_filters(self):
+        filters = super().message_filters()
+        filters.insert(2, ("read", self._filter_read))
+        return filters
+
+    def _filter_read(self, message):
+        return "unread" not in message["_rawMessage"]
+
+    # Every outgoing frame goes through here
+    def _send_frame(self, frame):
+        self.ws.send(frame)
+        self.frames_sent += 1
 
     # Opens the server connection
     def _connect(self):
         self.logger.info("Connecting to {}\n".format(self.web_socket_address))
+        self._connect_started = time.perf_counter()
         # Send Connection Request
         connect_request = {
             "msg": "connect",
             "version": "1",
             "support": ["1", "pre2", "pre1"]
         }
-        self.ws.send(json.dumps(connect_request))
+        self._send_frame(self.codec.dumps(connect_request))
 
     # Sends a login request
+    # Uses the resume token from an earlier login when we have one,
+    # which spares the server the password check after a reconnect
     def _login(self):
+        if self.user_token is not None:
+            self.logger.info("Resuming session as {}\n".format(self.user))
+            self._resuming = True
+            login_request = {
+                "msg": "method",
+                "method": "login",
+                "id": self.login_id,
+                "params": [
+                    {"resume": self.user_token}
+                ]
+            }
+            self._send_frame(self.codec.dumps(login_request))
+            return
+
         self.logger.info("Logging in as {}\n".format(self.user))
+        self._resuming = False
         login_request = {
             "msg": "method",
             "method": "login",
@@ -133,7 +825,7 @@ class WebsocketRocketBot(RocketBot):
                 }
             ]
         }
-        self.ws.send(json.dumps(login_request))
+        self._send_frame(self.codec.dumps(login_request))
 
     # Join a room
     def join_room(self, room_name):
@@ -147,30 +839,83 @@ class WebsocketRocketBot(RocketBot):
         if room is None:
             raise AssertionError("Requested room does not exist")
 
-        id = str(uuid.uuid4())
+        return self.call_method("joinRoom", [room["_id"]])
+
+    # Call a DDP method. Returns a concurrent.futures.Future that resolves
+    # to the call's result, or fails with MethodCallError if the server
+    # returns an error, or TimeoutError after timeout seconds.
+    # The result is set by the thread that reads the socket, which is also
+    # the thread inline handlers run on. Calling .result() from such a
+    # handler raises AssertionError rather than blocking every room
+    # forever. Use add_done_callback() there, or chat_workers so handlers
+    # run on their own threads, or AsyncWebsocketRocketBot.call().
+    def call_method(self, method, params, timeout=None):
+        return self._call_method(method, params, timeout)
+
+    # outbox_key puts the frame on the rate limited queue under that key
+    # (a room id) when rate limiting is on. on_sent is called once the
+    # frame is written. The timeout of a queued call only starts then, time
+    # spent waiting on the rate limiter doesn't count against it.
+    def _call_method(self, method, params, timeout=None, outbox_key=None, on_sent=None):
+        if not self.logged_in:
+            raise AssertionError("Called call_method without being logged in")
 
-        # Prepare join request
-        join_request = {
+        id = str(uuid.uuid4())
+        queued = outbox_key is not None and self._outbox is not None
+        future = self._pending_calls.add(id, method, None if queued else timeout)
+        method_request = {
             "msg": "method",
-            "method": "joinRoom",
+            "method": method,
             "id": id,
-            "params": [
-                room["_id"],
-            ]
+            "params": params
         }
-        # Track outstanding requests
-        self._room_requests[id] = room
-        # Send join request
-        self.ws.send(json.dumps(join_request))
+        method_frame = self.codec.dumps(method_request)
+        self.logger.debug("Calling method: %s", method_frame)
+        if not queued:
+            self._send_frame(method_frame)
+            if on_sent is not None:
+                on_sent()
+        else:
+            self._outbox.put(outbox_key, method_frame, lambda: self._queued_call_sent(id, timeout, on_sent))
+        return future
+
+    def _queued_call_sent(self, id, timeout, on_sent):
+        if timeout is not None:
+            self._pending_calls.start_timeout(id, timeout)
+        if on_sent is not None:
+            on_sent()
+
+    # Method calls still waiting for their result
+    def pending_call_count(self):
+        return len(self._pending_calls)
 
     # Subscribe to all messages from a room
     def _subscribe_room(self, room):
         if not self.logged_in:
             raise AssertionError("Called _subscribe_room without being logged in")
+        # Already covered by __my_messages__
+        if self.single_subscription:
+            return
 
-        id = str(uuid.uuid4())
         self.logger.info("Subscribing to room {}".format(room["_catName"]))
-        self.logger.debug("Subscribing to room {}".format(json.dumps(room)))
+        self._send_frame(self._subscribe_frame(room))
+
+    # Subscribe to many rooms at once. All frames are built first and then
+    # sent back to back, without waiting on anything in between.
+    def _subscribe_rooms(self, rooms):
+        if not self.logged_in:
+            raise AssertionError("Called _subscribe_rooms without being logged in")
+        if self.single_subscription:
+            return
+
+        self.logger.info("Subscribing to {} rooms".format(len(rooms)))
+        frames = [self._subscribe_frame(room) for room in rooms]
+        for frame in frames:
+            self._send_frame(frame)
+
+    def _subscribe_frame(self, room):
+        id = str(uuid.uuid4())
+        self.logger.debug("Subscribing to room %s", _LazyJson(room))
         subscribe_request = {
             "msg": "sub",
             "id": id,
@@ -180,7 +925,15 @@ class WebsocketRocketBot(RocketBot):
                 False
             ]
         }
-        self.ws.send(json.dumps(subscribe_request))
+        return self.codec.dumps(subscribe_request)
+
+    # One subscription for messages from every room we're in
+    def _subscribe_to_my_messages(self):
+        if not self.logged_in:
+            raise AssertionError("Called _subscribe_to_my_messages without being logged in")
+
+        self.logger.info("Subscribing to __my_messages__")
+        self._send_frame(self._subscribe_frame({"_id": "__my_messages__"}))
 
     def _subscribe_to_self_events(self):
         if not self.logged_in:
@@ -189,6 +942,7 @@ class WebsocketRocketBot(RocketBot):
         id = str(uuid.uuid4())
         self.logger.info("Subscribing to self events")
         self._user_event_key = "{}/rooms-changed".format(self.user_id)
+        self.add_route("changed", self._route_room_event, "stream-notify-user", self._user_event_key)
         subscribe_request = {
             "msg": "sub",
             "id": id,
@@ -198,7 +952,7 @@ class WebsocketRocketBot(RocketBot):
                 False
             ]
         }
-        self.ws.send(json.dumps(subscribe_request))
+        self._send_frame(self.codec.dumps(subscribe_request))
 
     # Play ping pong (keepalive)
     def _send_pong(self):
@@ -206,12 +960,13 @@ class WebsocketRocketBot(RocketBot):
             "msg": "pong"
         }
 
-        self.logger.debug("Sending pong: {}".format(json.dumps(ping_reply)))
-        self.ws.send(json.dumps(ping_reply))
+        ping_frame = self.codec.dumps(ping_reply)
+        self.logger.debug("Sending pong: %s", ping_frame)
+        self._send_frame(ping_frame)
 
     # Auto subscribe to channels upon @ or DM
     def _handle_room_event(self, message):
-        self.logger.debug("Incoming room event: {}".format(message))
+        self.logger.debug("Incoming room event: %s", message)
         channel = message[1]
         cid = channel["_id"]
         # If channel is chat/private chat/livechat
@@ -219,14 +974,13 @@ class WebsocketRocketBot(RocketBot):
             cname = "#{}".format(channel["name"])
         # or channel is instant message
         else:
-            my_ims = self._rest_api_get("/api/v1/im.list")["ims"]
-            for im in my_ims:
-                im_users = list(im["usernames"])
-                im_users.remove(self.user)
-                imname = "_".join(sorted(im_users))
-                if im["_id"] == cid:
-                    cname = imname
-                    break
+            if message[0] == "removed":
+                self._dm_names_by_id.pop(cid, None)
+                return
+            cname = self._dm_name(channel)
+            if cname is None:
+                self.logger.warning("Unknown DM room: {}".format(cid))
+                return
         channel["_catName"] = cname
 
         # If channel is not subscribed it's not in room_list
@@ -235,83 +989,193 @@ class WebsocketRocketBot(RocketBot):
             self.room_list_by_id[cid] = channel
             self._subscribe_room(channel)
 
-    # Override this with your own message handler
+    # Register a handler for incoming frames. Frames are matched on
+    # (msg, collection, eventName) and None in collection or event_name
+    # matches anything. Lookup tries the exact key, then any event in the
+    # collection, then the event in any collection, then just msg.
+    # Subclasses can add routes
+    # (or replace the default ones) instead of overriding _handle_message.
+    def add_route(self, msg, handler, collection=None, event_name=None):
+        self._routes[(msg, collection, event_name)] = handler
+
+    def _add_default_routes(self):
+        self.add_route("ping", self._route_ping)
+        self.add_route("connected", self._route_connected)
+        self.add_route("result", self._route_result)
+        self.add_route("ready", self._route_ready)
+        self.add_route("changed", self._route_room_message, "stream-room-messages")
+        self.add_route("changed", self._route_unknown)
+
+    # Looks the frame up in the route table and times the handler
     def _handle_message(self, message):
         if "server_id" in message:
             self._server_id = message["server_id"]
             return
 
-        command = message["msg"]
+        command = message.get("msg")
+        collection = message.get("collection")
+        fields = message.get("fields")
+        event_name = fields.get("eventName") if fields else None
 
-        # Table Tennis!
-        if command == "ping":
-            self._send_pong()
+        routes = self._routes
+        key = (command, collection, event_name)
+        handler = routes.get(key)
+        if handler is None:
+            key = (command, collection, None)
+            handler = routes.get(key)
+            if handler is None:
+                key = (command, None, event_name)
+                handler = routes.get(key)
+                if handler is None:
+                    key = (command, None, None)
+                    handler = routes.get(key, self._route_unknown)
 
-        # Server acks connections, send login request
-        elif command == "connected":
+        started = time.perf_counter()
+        try:
+            handler(message)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = self._route_stats.get(key)
+            if stats is None:
+                stats = self._route_stats[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    # Per route frame counts and handler timings, keyed by "msg/collection/eventName"
+    def route_stats(self):
+        stats = {}
+        for key, (count, total, worst) in self._route_stats.items():
+            stats["/".join(part for part in key if part is not None)] = {
+                "count": count,
+                "total_ms": total * 1000,
+                "avg_ms": total * 1000 / count,
+                "max_ms": worst * 1000,
+            }
+        return stats
+
+    # Table Tennis!
+    def _route_ping(self, message):
+        self._send_pong()
+
+    # Server acks connections, send login request
+    def _route_connected(self, message):
+        self._login()
+
+    # We got a result.
+    def _route_result(self, message):
+        result_id = message.get("id")
+        # Answer to our login request
+        if result_id == self.login_id:
+            if "error" in message:
+                self._handle_login_error(message)
+                return
+            self.logged_in = True
+            self._reconnect_attempt = 0
+            self.user_id = message["result"]["id"]
+            self.user_token = message["result"]["token"]
+            self._rest_session.headers.update({
+                "X-Auth-Token" : self.user_token,
+                "X-User-Id": self.user_id
+            })
+            self._handle_logged_in(message)
+        # Answer to a call_method() call
+        elif self._pending_calls.resolve(message):
+            return
+        # Pass result to generic handler
+        else:
+            self._run_handler(self.handle_result, message)
+
+    def _handle_login_error(self, message):
+        if self._resuming:
+            self.logger.warning("Resume token rejected, logging in with password")
+            self.user_token = None
             self._login()
+        else:
+            raise AssertionError("Login failed: {}".format(message["error"]))
 
-        # We got a result.
-        elif command == "result":
-            result_id = message.get("id")
-            # Answer to our login request
-            if result_id == self.login_id:
-                self.logged_in = True
-                self.user_id = message["result"]["id"]
-                self.user_token = message["result"]["token"]
-                self._handle_logged_in(message)
-            # Pass result to generic handler
-            else:
-                self.handle_result(message)
-
-        # Pass message to handler
-        elif command == "ready":
-            self.handle_ready(message)
-        elif command == "changed":
-            # Some room change notification
-            if message["fields"]["eventName"] == self._user_event_key:
-                self._handle_room_event(message["fields"]["args"])
-            # Assuming this is a message
-            else:
-                # Get the args dict out of the message
-                args = message["fields"]["args"][0]
-
-                # Get some arguments from the argsdict
-                room_id = args["rid"]
-                room = self.room_list_by_id[room_id]["_catName"]
-
-                # Make a dict that looks like a message you'd get from an outgoing integration
-                api_style_message = {
-                    "token": None, # No tokens when using web sockets :)
-                    "bot": False, # TODO: Have no data, should maybe query user info separately if unknown
-                    "channel_id": room_id,
-                    "channel_name": room,
-                    "message_id": args["_id"],
-                    "timestamp": args["ts"]["$date"], # TODO: Wrong format, needs strftime'd
-                    "user_id": args["u"]["_id"],
-                    "user_name": args["u"]["username"],
-                    "text": args["msg"],
-                    "isEdited": True if args.get("editedBy") is not None else False,
-                    "_rawMessage": args,
-                }
+    def _route_ready(self, message):
+        self._run_handler(self.handle_ready, message)
 
-                self._last_message_channel = room
+    # Some room change notification
+    def _route_room_event(self, message):
+        self._handle_room_event(message["fields"]["args"])
 
+    def _route_room_message(self, message):
+        # Get the args dict out of the message
+        args = message["fields"]["args"][0]
+
+        # Get some arguments from the argsdict
+        room_id = args["rid"]
+        joined_room = self.room_list_by_id.get(room_id)
+        # __my_messages__ can deliver a message before the room event for
+        # a room we were just added to
+        if joined_room is None:
+            self.logger.warning("Dropping message for unknown room {}".format(room_id))
+            return
+        room = joined_room["_catName"]
+
+        # Make a dict that looks like a message you'd get from an outgoing integration
+        api_style_message = {
+            "token": None, # No tokens when using web sockets :)
+            "bot": False, # TODO: Have no data, should maybe query user info separately if unknown
+            "channel_id": room_id,
+            "channel_name": room,
+            "message_id": args["_id"],
+            "timestamp": args["ts"]["$date"], # TODO: Wrong format, needs strftime'd
+            "user_id": args["u"]["_id"],
+            "user_name": args["u"]["username"],
+            "text": args["msg"],
+            "isEdited": True if args.get("editedBy") is not None else False,
+            "_rawMessage": args,
+        }
+
+        self._last_message_channel = room
+        _current_channel.set(room)
+
+        timings = None
+        received = self._frame_received_at
+        if received is not None:
+            timings = MessageTimings(received, self._frame_parsed_at, time.perf_counter())
+            # Server timestamps are wall clock, so shift the receive time onto it
+            received_wall = time.time() - (timings.dispatched - received)
+            self._record_latency("recv", received_wall - args["ts"]["$date"] / 1000)
+            self._record_latency("parse", timings.parsed - received)
+            self._record_latency("dispatch", timings.dispatched - timings.parsed)
+        token = _current_timings.set(timings)
+        try:
+            if self._chat_executor is None:
                 self._handle_chat_message(api_style_message)
-        else:
-            self.handle_unknown(message)
+            else:
+                context = contextvars.copy_context()
+                self._chat_executor.submit(room_id, context.run,
+                                           self._handle_chat_message_in_worker,
+                                           api_style_message)
+        finally:
+            _current_timings.reset(token)
+
+    def _route_unknown(self, message):
+        self.handle_unknown(message)
+
+    # Exceptions can't reach start() from a worker thread, log them here
+    def _handle_chat_message_in_worker(self, message):
+        try:
+            self._handle_chat_message(message)
+        except Exception as e:
+            self._log_exception(e)
 
     # Override this with your own results handler (if desired)
     def handle_result(self, message):
-        self.logger.debug("Unhandled result event: {}".format(message))
+        self.logger.debug("Unhandled result event: %s", message)
 
     # Override this with your own ready handler (if desired)
     def handle_ready(self, message):
-        self.logger.debug("Unhandled ready event: {}".format(message))
+        self.logger.debug("Unhandled ready event: %s", message)
 
     # Override this with your own handler for unknown messages (if desired)
     def handle_unknown(self, message):
-        self.logger.debug("Unhandled unknown event: {}".format(message))
+        self.logger.debug("Unhandled unknown event: %s", message)
 
     # Send a message to a channel
     def send_message(self, text, channel_name, attachments = None):
@@ -334,117 +1198,590 @@ class WebsocketRocketBot(RocketBot):
         if attachments != None:
             message["parseUrls"] = False
 
-        msg_request = {
-            "msg": "method",
-            "method": "sendMessage",
-            "id": str(uuid.uuid4()),
-            "params": [message]
+        ack = CallFuture(lambda: self._receive_thread)
+        ack.set_running_or_notify_cancel()
+        started = time.perf_counter()
+        timings = _current_timings.get()
+        received = timings.received if timings is not None else None
+        self._send_attempt(message, ack, 1, started,
+                           lambda: self._record_send_latency(started, received))
+        return ack
+
+    def _record_send_latency(self, started, received):
+        sent = time.perf_counter()
+        self._record_latency("send", sent - started)
+        if received is not None:
+            self._record_latency("total", sent - received)
+
+    # Returns a future that resolves once the server has acked the message
+    def _send_attempt(self, message, ack, attempt, started, on_sent=None):
+        call = self._call_method("sendMessage", [message], self.send_ack_timeout, message["rid"], on_sent)
+        call.add_done_callback(lambda call: self._send_done(call, message, ack, attempt, started))
+
+    def _send_done(self, call, message, ack, attempt, started):
+        e = call.exception()
+        if e is None or (attempt > 1 and self._is_duplicate_send(e)):
+            self.sends_acked += 1
+            self._ack_latencies.append(time.perf_counter() - started)
+            ack.set_result(call.result() if e is None else None)
+            return
+
+        rate_limited = isinstance(e, MethodCallError) and self._is_rate_limited(e)
+        if not rate_limited and (attempt > self.send_retries or isinstance(e, MethodCallError)):
+            self._send_failed(message, ack, attempt, e)
+            return
+
+        self.sends_retried += 1
+        self.logger.warning("Resending message {} ({})".format(message["_id"], e))
+        if rate_limited:
+            # The server turned the message away without storing it, waiting
+            # out its rate limit doesn't use up an attempt
+            timer = threading.Timer(self._rate_limit_delay(e), self._resend, (message, ack, attempt, started))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._resend(message, ack, attempt + 1, started)
+
+    def _send_failed(self, message, ack, attempt, e):
+        self.sends_failed += 1
+        self.logger.error("Giving up on message {} after {} attempts: {}".format(message["_id"], attempt, e))
+        ack.set_exception(e)
+
+    # Messages that can't go out while we're disconnected wait for the
+    # next login. Resends run in future callbacks, timers and the login
+    # handler, where nobody would see an exception, so a resend that
+    # raises either waits for the next login (the connection went away
+    # under it) or fails ack (the pending call limit was hit).
+    def _resend(self, message, ack, attempt, started):
+        if self.logged_in:
+            try:
+                self._send_attempt(message, ack, attempt, started)
+                return
+            except AssertionError as e:
+                if self.logged_in:
+                    self._send_failed(message, ack, attempt, e)
+                    return
+            except Exception as e:
+                self.logger.warning("Couldn't resend message {}, waiting for the next login: {}".format(
+                    message["_id"], e))
+        self._unacked_sends.append((message, ack, attempt, started))
+
+    def _resend_unacked(self):
+        unacked = self._unacked_sends
+        self._unacked_sends = []
+        for retry in unacked:
+            self._resend(*retry)
+
+    # The server rate limiter answers with too-many-requests
+    def _is_rate_limited(self, e):
+        return isinstance(e.error, dict) and e.error.get("error") == "too-many-requests"
+
+    # Seconds until the rate limit resets. Meteor puts timeToReset (ms) in
+    # the error's details, older servers at the top level.
+    def _rate_limit_delay(self, e):
+        details = e.error.get("details")
+        time_to_reset = details.get("timeToReset") if isinstance(details, dict) else None
+        if time_to_reset is None:
+            time_to_reset = e.error.get("timeToReset", 1000)
+        return time_to_reset / 1000
+
+    # A resend of a message that did arrive the first time fails on the
+    # duplicate _id, which means the first attempt made it
+    def _is_duplicate_send(self, e):
+        if not isinstance(e, MethodCallError):
+            return False
+        error = str(e.error)
+        return "E11000" in error or "duplicate" in error.lower()
+
+    # Time from send_message() to the server's ack, in ms
+    def send_ack_stats(self):
+        latencies = sorted(self._ack_latencies)
+        stats = {
+            "acked": self.sends_acked,
+            "retried": self.sends_retried,
+            "failed": self.sends_failed,
+            "unacked": len(self._unacked_sends),
         }
+        for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99), ("max_ms", 1.0)):
+            value = _percentile(latencies, q)
+            stats[name] = value * 1000 if value is not None else None
+        return stats
 
-        self.logger.debug("Sending message: {}".format(json.dumps(msg_request)))
-        self.ws.send(json.dumps(msg_request))
+    # Messages waiting on the rate limiter
+    def outbound_queue_depth(self):
+        if self._outbox is None:
+            return 0
+        return self._outbox.depth()
 
     def respond(self, text, attachments = None, channel = None):
-        if not self._last_message_channel:
-            raise AssertionError("No message to respond to")
         if not channel:
-            channel = self._last_message_channel
-        self.send_message(text, channel, attachments)
+            channel = _current_channel.get() or self._last_message_channel
+        if not channel:
+            raise AssertionError("No message to respond to")
+        batch = _response_batch.get()
+        if batch is None:
+            self.send_message(text, channel, attachments)
+        elif batch and batch[-1][0] == channel and batch[-1][2] is None and attachments is None:
+            batch[-1][1].append(text)
+        else:
+            batch.append([channel, [text], attachments])
+
+    def _run_handler(self, handler, message):
+        started = self._handler_started()
+        token = self._open_response_batch()
+        try:
+            handler(message)
+        finally:
+            self._close_response_batch(token)
+            self._handler_finished(started)
+
+    # Times the chat handler, returns None for every other handler
+    def _handler_started(self):
+        timings = _current_timings.get()
+        if timings is None or timings.filtered is None:
+            return None
+        started = time.perf_counter()
+        self._record_latency("queue", timings.queued + started - timings.filtered)
+        return started
+
+    def _handler_finished(self, started):
+        if started is not None:
+            self._record_latency("handler", time.perf_counter() - started)
+
+    # While a batch is open respond() collects responses instead of sending,
+    # closing it sends one message per run of responses to the same room
+    def _open_response_batch(self):
+        if not self.coalesce_responses:
+            return None
+        return _response_batch.set([])
+
+    def _close_response_batch(self, token):
+        if token is None:
+            return
+        batch = _response_batch.get()
+        _response_batch.reset(token)
+        for channel, texts, attachments in batch:
+            self.send_message("\n".join(texts), channel, attachments)
 
     def _rest_api_get(self, api_method):
-        rest_api_endpoint = "https://{}{}".format(self.domain, api_method)
+        rest_api_endpoint = "{}{}".format(self.rest_address, api_method)
         if not self.logged_in:
             raise AssertionError("Not logged in")
-        r = requests.get(rest_api_endpoint,
-                         headers = {
-                             "X-Auth-Token" : self.user_token,
-                             "X-User-Id": self.user_id
-                         })
-        response_json = r.json()
+        self._rest_calls += 1
+        started = time.perf_counter()
+        r = self._rest_session.get(rest_api_endpoint, timeout=self.rest_timeout)
+        elapsed = time.perf_counter() - started
+        endpoint = api_method.split("?", 1)[0]
+        histogram = self._rest_latency.get(endpoint)
+        if histogram is None:
+            histogram = self._rest_latency.setdefault(endpoint, LatencyHistogram())
+        histogram.record(elapsed)
+        response_json = self.codec.loads(r.content)
         return response_json
 
+    # Per endpoint REST call latency, in ms
+    def rest_latency_stats(self):
+        return {endpoint: histogram.stats() for endpoint, histogram in list(self._rest_latency.items())}
+
+    # Walks a paginated REST list with count/offset and yields one page
+    # (the list found under key) at a time, so only one page is in memory
+    def _rest_api_paged(self, api_method, key):
+        separator = "&" if "?" in api_method else "?"
+        offset = 0
+        while True:
+            response = self._rest_api_get("{}{}count={}&offset={}".format(
+                api_method, separator, self.rest_page_size, offset))
+            page = response[key]
+            if not page:
+                return
+            yield page
+            offset += len(page)
+            # Servers can cap count below rest_page_size (API_Upper_Count_Limit),
+            # so a short page only means the end when there's no total
+            total = response.get("total")
+            if total is not None:
+                if offset >= total:
+                    return
+            elif len(page) < self.rest_page_size:
+                return
+
+    # How many REST calls went out and how many of them got to reuse an
+    # already open connection instead of doing a new TCP+TLS handshake
+    def rest_connection_stats(self):
+        opened = 0
+        pools = self._rest_adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+        return {
+            "calls": self._rest_calls,
+            "connections_opened": opened,
+            "connections_reused": max(self._rest_calls - opened, 0),
+        }
+
     # Ask the REST api for a list of all public channels. Used for ID lookups.
     def populate_room_list(self):
-        rooms = self._rest_api_get("/api/v1/channels.list")
-        channels = rooms["channels"]
-        for channel in channels:
-            cname = "#{}".format(channel["name"])
-            cid = channel["_id"]
-            self.all_room_list[cname] = channel
-            self.all_room_list_by_id[cid] = channel
+        for channels in self._rest_api_paged("/api/v1/channels.list", "channels"):
+            for channel in channels:
+                cname = "#{}".format(channel["name"])
+                cid = channel["_id"]
+                self.all_room_list[cname] = channel
+                self.all_room_list_by_id[cid] = channel
 
+    # Name used for DM rooms: the other users, sorted and joined by "_"
+    def _im_name(self, im):
+        im_users = list(im["usernames"])
+        im_users.remove(self.user)
+        return "_".join(sorted(im_users))
+
+    # Look up the name of a DM room. Room events usually carry the usernames,
+    # otherwise use the index and only ask im.list when the room is new to us.
+    def _dm_name(self, channel):
+        cid = channel["_id"]
+        if "usernames" in channel:
+            self._dm_names_by_id[cid] = self._im_name(channel)
+        elif cid not in self._dm_names_by_id:
+            self.logger.debug("DM index miss for %s, refreshing from im.list", cid)
+            for ims in self._rest_api_paged("/api/v1/im.list", "ims"):
+                for im in ims:
+                    self._dm_names_by_id[im["_id"]] = self._im_name(im)
+        return self._dm_names_by_id.get(cid)
+
+    # The three room lists are walked in parallel. Each page of rooms is
+    # added to room_list and subscribed in one burst as soon as it arrives.
     def _subscribe_to_joined_rooms(self):
-        my_channels = self._rest_api_get("/api/v1/channels.list.joined")["channels"]
-        for channel in my_channels:
-            cname = "#{}".format(channel["name"])
-            cid = channel["_id"]
-            channel["_catName"] = cname
-            self.room_list[cname] = channel
-            self.room_list_by_id[cid] = channel
-            self._subscribe_room(channel)
-        my_groups = self._rest_api_get("/api/v1/groups.list")["groups"]
-        for group in my_groups:
-            gname = "#{}".format(group["name"])
-            gid = group["_id"]
-            group["_catName"] = gname
-            self.room_list[gname] = group
-            self.room_list_by_id[gid] = group
-            self._subscribe_room(group)
-        my_ims = self._rest_api_get("/api/v1/im.list")["ims"]
-        for im in my_ims:
-            im_users = list(im["usernames"])
-            im_users.remove(self.user)
-            imname = "_".join(sorted(im_users))
-            imid = im["_id"]
-            im["_catName"] = imname
-            self.room_list[imname] = im
-            self.room_list_by_id[imid] = im
-            self._subscribe_room(im)
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="rocketbot-discovery") as pool:
+            discoveries = [
+                pool.submit(self._discover_rooms, "/api/v1/channels.list.joined", "channels", self._add_joined_channel),
+                pool.submit(self._discover_rooms, "/api/v1/groups.list", "groups", self._add_joined_channel),
+                pool.submit(self._discover_rooms, "/api/v1/im.list", "ims", self._add_joined_im),
+            ]
+            for discovery in discoveries:
+                discovery.result()
+
+    def _discover_rooms(self, api_method, key, add_room):
+        for page in self._rest_api_paged(api_method, key):
+            self._subscribe_rooms([add_room(room) for room in page])
+
+    # Channels and private groups are both named "#name"
+    def _add_joined_channel(self, channel):
+        cname = "#{}".format(channel["name"])
+        cid = channel["_id"]
+        channel["_catName"] = cname
+        self.room_list[cname] = channel
+        self.room_list_by_id[cid] = channel
+        return channel
+
+    def _add_joined_im(self, im):
+        imname = self._im_name(im)
+        imid = im["_id"]
+        self._dm_names_by_id[imid] = imname
+        im["_catName"] = imname
+        self.room_list[imname] = im
+        self.room_list_by_id[imid] = im
+        return im
+
+    # After a reconnect the rooms we already know about are subscribed again
+    # straight from room_list_by_id instead of being rediscovered over REST
+    def _resubscribe_rooms(self):
+        self._subscribe_rooms(list(self.room_list_by_id.values()))
 
     def _handle_logged_in(self, message):
+        if self._rooms_discovered:
+            self._resubscribe_rooms()
+            if self.single_subscription:
+                self._subscribe_to_my_messages()
+            self._subscribe_to_self_events()
+            self._resend_unacked()
+            self.reconnect_seconds = time.perf_counter() - self._connect_started
+            self.logger.info("Reconnected in {:.0f} ms".format(self.reconnect_seconds * 1000))
+            self.bot_reconnected()
+            return
         self._subscribe_to_joined_rooms()
+        self._rooms_discovered = True
+        if self.single_subscription:
+            self._subscribe_to_my_messages()
         self._subscribe_to_self_events()
         # TODO: Need to subscribe to https://rocket.chat/docs/developer-guides/realtime-api/subscriptions/stream-notify-user/
+        self.startup_seconds = time.perf_counter() - self._connect_started
+        self.logger.info("Started up in {:.0f} ms with {} rooms".format(
+            self.startup_seconds * 1000, len(self.room_list_by_id)))
         self.bot_ready()
 
     def bot_ready(self):
         self.logger.info("Bot ready now")
 
+    # Called instead of bot_ready once the bot is back after a reconnect
+    def bot_reconnected(self):
+        self.logger.info("Bot reconnected")
+
+    # Full jitter backoff, the ceiling doubles with every failed attempt
+    def _reconnect_delay(self):
+        ceiling = min(self.reconnect_max_delay,
+                      self.reconnect_min_delay * 2 ** min(self._reconnect_attempt, 16))
+        self._reconnect_attempt += 1
+        return random.uniform(0, ceiling)
+
+    def _connection_lost(self, e):
+        self.logged_in = False
+        self._pending_calls.fail_all(e)
+        if not self.reconnect:
+            raise e
+        self.reconnects += 1
+        delay = self._reconnect_delay()
+        self.logger.warning("Connection lost ({}), reconnecting in {:.1f}s".format(e, delay))
+        return delay
+
     def start(self):
+        while True:
+            try:
+                self._run_connection()
+            except (websocket.WebSocketException, OSError) as e:
+                time.sleep(self._connection_lost(e))
+
+    def _run_connection(self):
+        self.logged_in = False
         self.ws = websocket.create_connection(self.web_socket_address)
-        self._connect()
+        try:
+            self._connect()
+            self._recv_loop()
+        finally:
+            self.ws.close()
+
+    def _recv_loop(self):
+        self._receive_thread = threading.current_thread()
         while True:
             msg = self.ws.recv()
+            received = time.perf_counter()
+            # recv() hands back an empty string for a close frame
+            if not msg:
+                raise websocket.WebSocketConnectionClosedException("Connection closed by server")
+            self._handle_frame(msg, received)
+
+    # Decodes one raw frame and dispatches it. received is when it was
+    # read off the socket.
+    def _handle_frame(self, msg, received):
+        self.frames_received += 1
+        if self._capture is not None:
+            self._capture_frame(msg)
+        message = self.codec.loads(msg)
+        self._frame_received_at = received
+        self._frame_parsed_at = time.perf_counter()
+        self.logger.debug("Web socket message: %s", msg)
+        try:
+            self._handle_message(message)
+        except Exception as e:
+            self._log_exception(e)
+            if self.raise_exceptions:
+                raise(e)
+
+    # A capture that can't be written (disk full, say) is given up rather
+    # than taking the receive loop down with it
+    def _capture_frame(self, msg):
+        if isinstance(msg, bytes):
+            record = {"t": time.time(), "frame_b64": base64.b64encode(msg).decode("ascii")}
+        else:
+            record = {"t": time.time(), "frame": msg}
+        try:
+            self._capture.write(json.dumps(record) + "\n")
+        except (OSError, ValueError) as e:
+            self.logger.error("Stopping frame capture: {}".format(e))
+            capture, self._capture = self._capture, None
+            try:
+                capture.close()
+            except (OSError, ValueError):
+                pass
+
+    def _log_latency(self):
+        while True:
+            time.sleep(self.latency_log_interval)
+            summary = self.latency_summary()
+            if summary:
+                self.logger.info("Message latency:\n{}".format(summary))
 
-            message = json.loads(msg)
-            self.logger.debug("Web socket message: {}".format(json.dumps(message)))
+    def _log_exception(self, e):
+        self.logger.error("Error handling message: {}".format(e))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(''.join(traceback.format_exception(type(e), e, e.__traceback__, limit=None, chain=True)))
+
+# Hands frames written with ws.send() from any thread to the event loop's
+# outbound queue, so the sender task is the only writer on the socket.
+class _LoopSocketWriter:
+    def __init__(self, loop, queue):
+        self._loop = loop
+        self._queue = queue
+
+    def send(self, data):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, data)
+
+# Asyncio based RocketBot
+# Same handlers as WebsocketRocketBot, but receiving, dispatching and sending
+# run as cooperating tasks on an event loop. Plain handlers run on a thread
+# pool, handlers written as coroutines (async def) run on the loop itself.
+# Either way a slow handler no longer holds up the socket.
+# max_concurrent_handlers takes the place of chat_workers, which isn't
+# supported here: the worker threads would start handler tasks off the
+# event loop's thread.
+class AsyncWebsocketRocketBot(WebsocketRocketBot):
+    def __init__(self, domain, user, password, raise_exceptions=False, max_concurrent_handlers=32, **kwargs):
+        if kwargs.get("chat_workers"):
+            raise AssertionError("AsyncWebsocketRocketBot doesn't support chat_workers, use max_concurrent_handlers")
+        super().__init__(domain, user, password, raise_exceptions, **kwargs)
+        self.max_concurrent_handlers = max_concurrent_handlers
+        self._loop = None
+        self._conn = None
+        self._handler_tasks = set()
+
+    # Start handlers as tasks instead of calling them inline. The task copies
+    # the current context, so respond() still knows which room to answer.
+    def _run_handler(self, handler, message):
+        task = self._loop.create_task(self._invoke_handler(handler, message))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+
+    async def _invoke_handler(self, handler, message):
+        async with self._handler_slots:
             try:
-                self._handle_message(message)
+                if asyncio.iscoroutinefunction(handler):
+                    started = self._handler_started()
+                    token = self._open_response_batch()
+                    try:
+                        await handler(message)
+                    finally:
+                        self._close_response_batch(token)
+                        self._handler_finished(started)
+                else:
+                    context = contextvars.copy_context()
+                    await self._loop.run_in_executor(self._handler_executor, context.run,
+                                                     super()._run_handler, handler, message)
             except Exception as e:
-                self.logger.error("Error handling message: {}".format(e))
-                self.logger.debug(''.join(traceback.format_exception(type(e), e, e.__traceback__, limit=None, chain=True)))
+                self._log_exception(e)
                 if self.raise_exceptions:
-                    raise(e)
+                    # Let the dispatcher stop the bot
+                    self._inbound.put_nowait(e)
+
+    # Room discovery and DM lookups hit the REST api, keep them off the loop.
+    # They share one thread so they still run in the order they arrived.
+    def _run_blocking(self, func, message):
+        context = contextvars.copy_context()
+        future = self._loop.run_in_executor(self._internal_executor, context.run, func, message)
+        task = asyncio.ensure_future(future)
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._blocking_done)
+
+    def _blocking_done(self, task):
+        self._handler_tasks.discard(task)
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            self._log_exception(e)
+            if self.raise_exceptions:
+                self._inbound.put_nowait(e)
+
+    def _handle_logged_in(self, message):
+        self._run_blocking(super()._handle_logged_in, message)
+
+    def _handle_room_event(self, message):
+        self._run_blocking(super()._handle_room_event, message)
+
+    async def _receiver(self):
+        while True:
+            msg = await self._loop.run_in_executor(self._io_executor, self._conn.recv)
+            received = time.perf_counter()
+            if not msg:
+                raise websocket.WebSocketConnectionClosedException("Connection closed by server")
+            await self._inbound.put((msg, received))
+
+    async def _dispatcher(self):
+        while True:
+            item = await self._inbound.get()
+            if isinstance(item, Exception):
+                raise item
+            self._handle_frame(*item)
+
+    async def _sender(self):
+        while True:
+            data = await self._outbound.get()
+            await self._loop.run_in_executor(self._io_executor, self._conn.send, data)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        # Results are resolved by _dispatcher, on the loop thread
+        self._receive_thread = threading.current_thread()
+        self._handler_slots = asyncio.Semaphore(self.max_concurrent_handlers)
+        self._handler_executor = ThreadPoolExecutor(max_workers=self.max_concurrent_handlers,
+                                                    thread_name_prefix="rocketbot-handler")
+        self._internal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rocketbot-rest")
+        # One thread blocks in recv(), the other one sends
+        self._io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rocketbot-io")
+        try:
+            while True:
+                try:
+                    await self._run_connection()
+                except (websocket.WebSocketException, OSError) as e:
+                    await asyncio.sleep(self._connection_lost(e))
+        finally:
+            for task in list(self._handler_tasks):
+                task.cancel()
+            for executor in (self._handler_executor, self._internal_executor, self._io_executor):
+                executor.shutdown(wait=False)
+
+    async def _run_connection(self):
+        self.logged_in = False
+        self._inbound = asyncio.Queue()
+        self._outbound = asyncio.Queue()
+        self._conn = await self._loop.run_in_executor(self._io_executor,
+                                                      websocket.create_connection,
+                                                      self.web_socket_address)
+        self.ws = _LoopSocketWriter(self._loop, self._outbound)
+        self._connect()
+
+        tasks = [
+            self._loop.create_task(self._receiver()),
+            self._loop.create_task(self._dispatcher()),
+            self._loop.create_task(self._sender()),
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._conn.close()
+
+    # call_method() for coroutines
+    async def call(self, method, params, timeout=None):
+        return await asyncio.wrap_future(self.call_method(method, params, timeout))
+
+    def start(self):
+        asyncio.run(self.run())
 
 # CGI based RocketBot
 # Uses the Rocket.chat integrations API
 class CGIRocketBot(RocketBot):
-    def __init__(self, user, token):
-        super().__init__(user)
+    def __init__(self, user, token, codec=None):
+        super().__init__(user, codec)
         self.token = token
         self._responded = False
         # Replace stdin reader with one that can decode UTF-8
         sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
 
     # Filters out messages that don't include the correct token
-    # messages on to the generic _handle_chat_message method
-    def _handle_chat_message(self, message):
-        if not "token" in message:
-            self.logger.debug("Filtering out message with no token")
-        elif message["token"] != self.token:
-            self.logger.debug("Filtering out message an invalid token")
-        else:
-            super()._handle_chat_message(message)
+    # before the generic filters
+    def message_filters(self):
+        return [
+            ("no_token", self._filter_no_token),
+            ("bad_token", self._filter_bad_token),
+        ] + super().message_filters()
+
+    def _filter_no_token(self, message):
+        return "token" not in message
+
+    def _filter_bad_token(self, message):
+        return message["token"] != self.token
 
     # Respond to the incoming message
     def respond(self, text, attachments = None, channel = None):
@@ -455,14 +1792,14 @@ class CGIRocketBot(RocketBot):
         }
 
         if self._responded:
-            self.logger.warning("Trying to respond more than once: {}".format(json.dumps(response)))
+            self.logger.warning("Trying to respond more than once: {}".format(self.codec.dumps(response)))
             return
         else:
-            self.logger.info("Responding: {}".format(json.dumps(response)))
+            self.logger.info("Responding: {}".format(self.codec.dumps(response)))
             self._responded = True
             print("Content-Type: application/json")
             print()
-            print(json.dumps(response))
+            print(self.codec.dumps(response))
 
     # Respond to the incoming message with a null response
     def _bail(self):
@@ -472,8 +1809,8 @@ class CGIRocketBot(RocketBot):
 
     def start(self):
         body = sys.stdin.read()
-        body_json = json.loads(body)
-        self.logger.debug("Incoming message: {}".format(json.dumps(body_json)))
+        body_json = self.codec.loads(body)
+        self.logger.debug("Incoming message: %s", body)
         self._handle_chat_message(body_json)
         if not self._responded:
             self._bail()